@@ -0,0 +1,3 @@
+"""
+    Benchmarks of redpush against a fake redash server. Run them with `python -m bench.run`
+"""
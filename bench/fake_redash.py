@@ -0,0 +1,277 @@
+"""
+    Minimal in-process stand-in for the Redash API, good enough to run redpush against it offline.
+    It keeps everything in memory and counts the requests it gets per endpoint
+"""
+import json
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+
+
+class FakeRedashState:
+    """
+        The data the fake server holds, plus the counters of what was requested
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.queries = {}
+        self.visualizations = {}
+        self.query_visualizations = {}  # query id -> ids of its visualizations
+        self.dashboards = {}
+        self.widgets = {}
+        self.users = {}
+        self.jobs = {}
+        self.next_id = 1
+        self.requests = Counter()
+        self.fail_next = 0  # answer this many requests with a 503
+
+    def new_id(self):
+        with self.lock:
+            new_id = self.next_id
+            self.next_id += 1
+            return new_id
+
+    def populate(self, queries=100, visualizations=2, dashboards=10):
+        """
+            Fill the server with a synthetic dataset, every query tracked by a redpush_id
+        """
+        dash_ids = []
+        for d in range(dashboards):
+            dash = self.create_dashboard({'name': 'dashboard-{}'.format(d)})
+            dash['is_draft'] = False
+            dash_ids.append(dash['id'])
+        for q in range(queries):
+            query = self.save_query(None, {
+                'name': 'query {}'.format(q),
+                'description': 'description of query {}'.format(q),
+                'query': 'SELECT {} FROM table_{}\nWHERE x > {}'.format(q, q % 17, q),
+                'data_source_id': 1,
+                'options': {'redpush_id': q + 1, 'parameters': []},
+            })
+            for v in range(visualizations):
+                visual = self.save_visualization(None, {
+                    'query_id': query['id'], 'type': 'CHART', 'name': 'chart {}'.format(v),
+                    'description': '', 'options': {'redpush_id': v + 1, 'globalSeriesType': 'line'}})
+                if dash_ids:
+                    dash_id = dash_ids[(q * visualizations + v) % len(dash_ids)]
+                    self.save_widget(None, {'dashboard_id': dash_id, 'visualization_id': visual['id'],
+                                            'options': {'position': {'autoHeight': False, 'row': q, 'col': 0, 'sizeX': 3, 'sizeY': 9}},
+                                            'width': 1, 'text': ''})
+
+    # -- objects -------------------------------------------------------------------------------
+
+    def save_query(self, query_id, body):
+        with self.lock:
+            if query_id is None:
+                query_id = self.next_id
+                self.next_id += 1
+                query = {'id': query_id, 'version': 0, 'is_archived': False, 'is_draft': True, 'options': {},
+                         'description': None, 'created_at': '2018-01-01T00:00:00', 'schedule': None}
+                self.queries[query_id] = query
+            query = self.queries[query_id]
+            for key in ['name', 'description', 'query', 'data_source_id', 'options', 'is_draft', 'is_archived']:
+                if key in body:
+                    query[key] = body[key]
+            query['version'] += 1
+            query['updated_at'] = '2018-01-01T00:00:{:02d}'.format(query['version'] % 60)
+            return self.query_detail(query_id, with_visuals=False)
+
+    def query_detail(self, query_id, with_visuals=True):
+        query = dict(self.queries[query_id])
+        if with_visuals:
+            query['visualizations'] = [dict(self.visualizations[v]) for v in self.query_visualizations.get(query_id, [])]
+        return query
+
+    def save_visualization(self, visual_id, body):
+        with self.lock:
+            if visual_id is None:
+                visual_id = self.next_id
+                self.next_id += 1
+                self.visualizations[visual_id] = {'id': visual_id, 'created_at': 'x', 'updated_at': 'x'}
+            visual = self.visualizations[visual_id]
+            if 'query_id' in body and body['query_id'] != visual.get('query_id'):
+                if 'query_id' in visual:
+                    self.query_visualizations[visual['query_id']].remove(visual_id)
+                self.query_visualizations.setdefault(body['query_id'], []).append(visual_id)
+            for key in ['query_id', 'type', 'name', 'description', 'options']:
+                if key in body:
+                    visual[key] = body[key]
+            return dict(visual)
+
+    def create_dashboard(self, body):
+        with self.lock:
+            dash_id = self.next_id
+            self.next_id += 1
+            dash = {'id': dash_id, 'name': body['name'], 'slug': body['name'].lower().replace(' ', '-'),
+                    'is_draft': True, 'is_archived': False, 'version': 1, 'layout': [], 'user_id': 1,
+                    'updated_at': 'x', 'created_at': 'x', 'dashboard_filters_enabled': False, 'tags': []}
+            self.dashboards[dash_id] = dash
+            return dict(dash)
+
+    def dashboard_detail(self, dash):
+        detail = dict(dash)
+        detail['widgets'] = []
+        for widget in self.widgets.values():
+            if widget['dashboard_id'] == dash['id']:
+                widget = dict(widget)
+                if widget.get('visualization_id') in self.visualizations:
+                    widget['visualization'] = dict(self.visualizations[widget['visualization_id']])
+                detail['widgets'].append(widget)
+        return detail
+
+    def save_widget(self, widget_id, body):
+        with self.lock:
+            if widget_id is None:
+                widget_id = self.next_id
+                self.next_id += 1
+                self.widgets[widget_id] = {'id': widget_id, 'created_at': 'x', 'updated_at': 'x'}
+            widget = self.widgets[widget_id]
+            for key in ['dashboard_id', 'visualization_id', 'options', 'width', 'text']:
+                if key in body:
+                    widget[key] = body[key]
+            return dict(widget)
+
+
+class FakeRedashHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def send_json(self, status, payload):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return {}
+        return json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+
+    def handle_any(self, method):
+        url = urlparse(self.path)
+        params = {k: v[0] for k, v in parse_qs(url.query).items()}
+        body = self.read_body() if method in ('POST', 'DELETE') else {}
+        endpoint = re.sub(r'/[^/]+$', '/<id>', url.path) if re.search(r'/api/\w+/.+$', url.path) else url.path
+        with self.state.lock:
+            # the handlers run in threads, and += on the counter isn't atomic
+            self.state.requests['{} {}'.format(method, endpoint)] += 1
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        with self.state.lock:
+            fail = self.state.fail_next > 0
+            if fail:
+                self.state.fail_next -= 1
+        if fail:
+            return self.send_json(503, {'message': 'try again'})
+        if self.headers.get('Authorization', '') != 'Key ' + self.server.api_key:
+            return self.send_json(403, {'message': 'forbidden'})
+        status, payload = self.route(method, url.path, params, body)
+        self.send_json(status, payload)
+
+    def route(self, method, path, params, body):
+        state = self.state
+        parts = path.strip('/').split('/')[1:]
+        resource = parts[0] if parts else ''
+        ident = parts[1] if len(parts) > 1 else None
+
+        if resource == 'queries':
+            if method == 'GET' and ident is None:
+                page = int(params.get('page', 1))
+                page_size = min(int(params.get('page_size', 25)), 250)
+                live = [state.query_detail(i, with_visuals=False) for i in sorted(state.queries)
+                        if not state.queries[i]['is_archived']]
+                start = (page - 1) * page_size
+                return 200, {'count': len(live), 'page': page, 'page_size': page_size,
+                             'results': live[start:start + page_size]}
+            if ident is not None and int(ident) not in state.queries:
+                return 404, {'message': 'not found'}
+            if method == 'GET':
+                return 200, state.query_detail(int(ident))
+            if method == 'POST':
+                return 200, state.save_query(int(ident) if ident else None, body)
+            if method == 'DELETE':
+                state.queries[int(ident)]['is_archived'] = True
+                return 200, {}
+        if resource == 'visualizations' and method == 'POST':
+            return 200, state.save_visualization(int(ident) if ident else None, body)
+        if resource == 'dashboards':
+            if method == 'GET' and ident is None:
+                return 200, [dict(d) for d in state.dashboards.values() if not d['is_archived']]
+            if method == 'GET':
+                for dash in state.dashboards.values():
+                    if dash['slug'] == ident:
+                        return 200, state.dashboard_detail(dash)
+                return 404, {'message': 'not found'}
+            if method == 'POST' and ident is None:
+                return 200, state.create_dashboard(body)
+            if method == 'POST':
+                dash = state.dashboards[int(ident)]
+                for key in ['name', 'is_draft']:
+                    if key in body:
+                        dash[key] = body[key]
+                dash['version'] += 1
+                return 200, dict(dash)
+        if resource == 'widgets' and method == 'POST':
+            return 200, state.save_widget(int(ident) if ident else None, body)
+        if resource == 'users':
+            if method == 'GET':
+                users = sorted(state.users.values(), key=lambda u: u['id'])
+                page = int(params.get('page', 1))
+                page_size = min(int(params.get('page_size', 25)), 250)
+                start = (page - 1) * page_size
+                return 200, {'count': len(users), 'page': page, 'page_size': page_size,
+                             'results': users[start:start + page_size]}
+            if method == 'POST':
+                if any(u['email'] == body.get('email') for u in state.users.values()):
+                    return 400, {'message': 'Email already taken.'}
+                user_id = state.new_id()
+                state.users[user_id] = {'id': user_id, 'name': body.get('name'), 'email': body.get('email')}
+                return 200, state.users[user_id]
+        if resource == 'query_results' and method == 'POST':
+            job_id = str(state.new_id())
+            state.jobs[job_id] = {'id': job_id, 'status': 3, 'query_result_id': state.new_id(), 'error': ''}
+            return 200, {'job': {'id': job_id, 'status': 1}}
+        if resource == 'jobs' and method == 'GET':
+            return 200, {'job': state.jobs[ident]}
+        return 404, {'message': 'unknown endpoint'}
+
+    def do_GET(self):
+        self.handle_any('GET')
+
+    def do_POST(self):
+        self.handle_any('POST')
+
+    def do_DELETE(self):
+        self.handle_any('DELETE')
+
+
+class FakeRedashServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_server(state, api_key='secret', host='127.0.0.1', port=0):
+    """
+        Serve the state in a background thread. Returns the server (call shutdown() to stop it) and its url
+    """
+    server = FakeRedashServer((host, port), FakeRedashHandler)
+    server.state = state
+    server.api_key = api_key
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server, 'http://{}:{}'.format(*server.server_address)
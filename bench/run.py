@@ -0,0 +1,166 @@
+"""
+    Time the redpush commands end to end against the fake redash server, for several dataset sizes.
+    For each command it records the wall and cpu time and the requests the server got (per endpoint), so
+    a change that makes redpush slower or chattier shows up. Everything runs offline, in this process
+    (so the cpu time includes the fake server too)
+"""
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import click
+from click.testing import CliRunner
+from ruamel import yaml
+from redpush.cli import cli
+from bench.fake_redash import FakeRedashState, start_server
+
+API_KEY = 'secret'
+
+
+def make_repo(dump_file, repo_file, fewer_file, dashboards):
+    """
+        Turn a dump into the files the benchmark pushes: every visualization placed in a dashboard, one
+        query out of ten changed and one out of twenty new. The fewer file has a tenth of the queries removed,
+        for archive
+    """
+    with open(dump_file) as stream:
+        queries = yaml.load(stream, yaml.RoundTripLoader) or []
+    for position, query in enumerate(queries):
+        if position % 10 == 0:
+            query['query'] = query['query'] + '\nLIMIT 1000'
+        for visual_position, visual in enumerate(query.get('visualizations') or []):
+            visual['redpush_dashboards'] = [{'name': 'dashboard-{}'.format(position % max(1, dashboards)),
+                                             'row': position, 'col': visual_position % 2, 'size': 'medium'}]
+    for new in range(len(queries) // 20):
+        queries.append({'name': 'new query {}'.format(new), 'query': 'SELECT {}'.format(new), 'data_source_id': 1,
+                        'redpush_id': 'new-{}'.format(new),
+                        'visualizations': [{'type': 'TABLE', 'name': 'Table', 'redpush_id': 1, 'options': {},
+                                            'redpush_dashboards': [{'name': 'new-dashboard', 'row': new, 'col': 0, 'size': 'small'}]}]})
+    with open(repo_file, 'w') as stream:
+        yaml.dump(queries, stream, Dumper=yaml.RoundTripDumper)
+    with open(fewer_file, 'w') as stream:
+        yaml.dump([query for position, query in enumerate(queries) if position % 10 != 5], stream, Dumper=yaml.RoundTripDumper)
+
+
+def run_command(runner, state, url, args):
+    """
+        Run one redpush command, returning what it cost
+    """
+    state.requests.clear()
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    result = runner.invoke(cli, args + ['--redash-url', url, '--api-key', API_KEY])
+    measure = {
+        'wall_seconds': time.perf_counter() - wall,
+        'cpu_seconds': time.process_time() - cpu,
+        'requests': sum(state.requests.values()),
+        'endpoints': dict(sorted(state.requests.items())),
+        'exit_code': result.exit_code,
+    }
+    if result.exit_code != 0:
+        print(result.output[-2000:], file=sys.stderr)
+        if result.exception is not None and not isinstance(result.exception, SystemExit):
+            raise result.exception
+    return measure
+
+
+def run_size(size, visualizations, dashboards, latency, concurrency, commands, directory):
+    """
+        Start a fake server with `size` queries and run the commands against it, in order
+    """
+    state = FakeRedashState(latency)
+    state.populate(size, visualizations, dashboards)
+    server, url = start_server(state, API_KEY)
+    runner = CliRunner()
+    dump_file = os.path.join(directory, 'dump-{}.yaml'.format(size))
+    repo_file = os.path.join(directory, 'repo-{}.yaml'.format(size))
+    fewer_file = os.path.join(directory, 'fewer-{}.yaml'.format(size))
+    concurrency_args = ['--concurrency', str(concurrency)]
+    # the dump is always done, as the other files come from it
+    steps = [
+        ('dump', ['dump', '-o', dump_file] + concurrency_args),
+        ('diff', ['diff', '-i', repo_file] + concurrency_args),
+        ('push', ['push', '-i', repo_file] + concurrency_args),
+        ('push (no changes)', ['push', '-i', repo_file] + concurrency_args),
+        ('archive', ['archive', '-i', fewer_file]),
+    ]
+    results = {}
+    try:
+        for name, args in steps:
+            if name != 'dump' and name.split()[0] not in commands:
+                continue
+            results[name] = run_command(runner, state, url, args)
+            if name == 'dump':
+                make_repo(dump_file, repo_file, fewer_file, dashboards)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+def print_results(results):
+    rows = [('queries', 'command', 'wall s', 'cpu s', 'requests')]
+    for size, commands in results.items():
+        for name, measure in commands.items():
+            rows.append((size, name, '{:.2f}'.format(measure['wall_seconds']), '{:.2f}'.format(measure['cpu_seconds']), measure['requests']))
+    widths = [max(len(str(row[column])) for row in rows) for column in range(len(rows[0]))]
+    for row in rows:
+        print('  '.join(str(cell).rjust(width) for cell, width in zip(row, widths)))
+
+
+def compare(results, baseline, tolerance):
+    """
+        The regressions against a previous run: more requests than before (they should be deterministic)
+        or more wall time than the tolerance allows
+    """
+    problems = []
+    for size, commands in results.items():
+        for name, measure in commands.items():
+            before = baseline.get(size, {}).get(name)
+            if before is None:
+                continue
+            if measure['requests'] > before['requests']:
+                problems.append('{} queries, {}: {} requests, {} before'.format(size, name, measure['requests'], before['requests']))
+            if measure['wall_seconds'] > before['wall_seconds'] * (1 + tolerance):
+                problems.append('{} queries, {}: {:.2f}s, {:.2f}s before'.format(size, name, measure['wall_seconds'], before['wall_seconds']))
+    return problems
+
+
+@click.command()
+@click.option('--sizes', default='100,1000', help="Comma separated number of queries of each run (e.g. 100,1000,10000)", type=str)
+@click.option('--visualizations', default=2, help="Visualizations per query", type=int)
+@click.option('--dashboards', default=10, help="Dashboards in the server", type=int)
+@click.option('--latency', default=0.005, help="Seconds the fake server waits before answering each request", type=float)
+@click.option('--concurrency', default=8, help="Concurrency passed to redpush", type=int)
+@click.option('--commands', default='dump,diff,push,archive', help="Commands to time (dump is always run)", type=str)
+@click.option('-o', '--out-file', help="Save the results as json", type=str)
+@click.option('--baseline', help="Json results of a previous run to compare against; exits with an error on regressions", type=str)
+@click.option('--tolerance', default=0.25, help="How much slower than the baseline is still fine (0.25 is 25%)", type=float)
+def main(sizes, visualizations, dashboards, latency, concurrency, commands, out_file, baseline, tolerance):
+    commands = set(commands.split(','))
+    directory = tempfile.mkdtemp(prefix='redpush-bench-')
+    results = {}
+    try:
+        for size in sizes.split(','):
+            results[size] = run_size(int(size), visualizations, dashboards, latency, concurrency, commands, directory)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    print_results(results)
+    if out_file:
+        with open(out_file, 'w') as stream:
+            json.dump({'settings': {'visualizations': visualizations, 'dashboards': dashboards, 'latency': latency,
+                                    'concurrency': concurrency}, 'results': results}, stream, indent=2, sort_keys=True)
+    if baseline:
+        with open(baseline) as stream:
+            problems = compare(results, json.load(stream)['results'], tolerance)
+        for problem in problems:
+            print('REGRESSION ' + problem)
+        if problems:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""
+    Asyncio version of the Redash class, to pipeline the requests of independent queries
+"""
+import asyncio
+import functools
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from redpush.index import RedpushIndex
+from redpush.plan import make_plan, operation_request, operation_done, new_chain, existing_objects, already_done
+from redpush.redash import Redash, QUERIES_PAGE_SIZE, USERS_PAGE_SIZE, response_json, remaining_pages, new_users, user_created, print_users_report
+
+
+class AsyncRedash:
+    """
+        Same operations as Redash, but as coroutines.
+        A semaphore limits how many requests are in flight; the requests themselves go through the pooled
+        session of a Redash object (with its retries, timeouts and cache), run in worker threads.
+        Use `run` to call the coroutines from normal code
+    """
+
+    def __init__(self, url, api_key, concurrency=8, **kwargs):
+        self.url = url
+        self.concurrency = max(1, concurrency)
+        self.server = Redash(url, api_key, self.concurrency, **kwargs)
+        self.cache = self.server.cache
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self.semaphore = None
+
+    def run(self, coroutine):
+        """
+            Run a coroutine of this object until it is done, and return its result
+        """
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+
+        async def main():
+            # the semaphore needs to be created inside the loop that uses it
+            self.semaphore = asyncio.Semaphore(self.concurrency)
+            return await coroutine
+
+        try:
+            return loop.run_until_complete(main())
+        finally:
+            loop.close()
+            asyncio.set_event_loop(None)
+
+    async def request(self, method, path, **kwargs):
+        """
+            Do a request when there is a free slot, and return the response
+        """
+        return await self.call(functools.partial(self.server.request, method, path, **kwargs))
+
+    async def call(self, function, *args):
+        """
+            Call a function of the Redash object (that does its requests, and uses its cache) when there is a free slot
+        """
+        loop = asyncio.get_event_loop()
+        async with self.semaphore:
+            return await loop.run_in_executor(self.executor, functools.partial(function, *args))
+
+    async def for_each(self, function, items):
+        """
+            Await function(item) for all the items, with at most `concurrency` of them running at the same time.
+            The items are only read as there is room for them, so they can be streamed
+        """
+        pending = set()
+        for item in items:
+            if len(pending) >= self.concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    task.result()  # raise its error, if any
+            pending.add(asyncio.ensure_future(function(item)))
+        if pending:
+            done, _ = await asyncio.wait(pending)
+            for task in done:
+                task.result()
+
+    async def request_json(self, method, path, **kwargs):
+        """
+            Do a request when there is a free slot, and return the decoded json. Errors are raised
+        """
+        return response_json(await self.request(method, path, **kwargs))
+
+    async def Get_Queries(self, dontfilter=False):
+        """
+            Get all queries (without visualizations). After the first page we know how many there are,
+            so the rest of pages are requested at the same time
+        """
+        path = "{}/api/queries".format(self.url)
+        first = await self.request_json('GET', path, params={'page': 1, 'page_size': QUERIES_PAGE_SIZE})
+        rest = await asyncio.gather(*[self.request_json('GET', path, params={'page': page, 'page_size': QUERIES_PAGE_SIZE})
+                                      for page in remaining_pages(first)])
+
+        queries = list(first['results'])
+        for response in rest:
+            queries.extend(response['results'])
+        if self.cache is not None:
+            self.cache.prune('queries', [query['id'] for query in queries])
+        if not dontfilter:
+            queries = self.server.filter_fields_query_list(queries)
+        return queries
+
+    async def Get_Full_Queries(self, queries):
+        """
+            Download the queries with their visualizations, all at the same time (up to the concurrency)
+        """
+        full_queries = await asyncio.gather(*[self.call(self.server.fetch_query_detail, query) for query in queries])
+        if self.cache is not None:
+            self.cache.save()
+        return list(full_queries)
+
+    async def Get_Server_State(self):
+        """
+            All the queries with their visualizations. Check Redash.Iter_Server_State
+        """
+        return await self.Get_Full_Queries(await self.Get_Queries(dontfilter=True))
+
+    async def Get_Dashboards(self):
+        """
+            Get all dashboards with their details
+        """
+        path = "{}/api/dashboards".format(self.url)
+        dash_id_list = await self.request_json('GET', path)
+        dashboards = await asyncio.gather(*[self.call(self.server.fetch_dashboard_detail, dash_id) for dash_id in dash_id_list])
+        if self.cache is not None:
+            self.cache.prune('dashboards', [dash_id['slug'] for dash_id in dash_id_list])
+            self.cache.save()
+        return list(dashboards)
+
+    async def Create_Dashboard(self, name):
+        """
+            Create a (published) dashboard. Check Redash.Create_Dashboard
+        """
+        path = "{}/api/dashboards".format(self.url)
+        response = await self.request_json('POST', path, json={'name': name})
+        response['is_draft'] = False
+        update = self.server.filter_fields_blacklist(response, ['updated_at', 'created_at', 'version'])
+        await self.request('POST', path + '/' + str(response['id']), json=update)  # it fails, but makes the change
+        return self.server.filter_dashboard(update)
+
+    async def Apply_Plan(self, plan, fresh=False):
+        """
+            Execute a plan (check redpush.plan). The operations of one query are awaited one after the other,
+            as each one needs the ids of the previous, but the queries are pipelined concurrently.
+            What is already in the server is skipped, unless the plan is fresh. Check apply_plan
+        """
+        done = Counter()
+        if fresh:
+            existing, live_ids = RedpushIndex(), None
+        else:
+            loop = asyncio.get_event_loop()
+            existing, live_ids = await loop.run_in_executor(self.executor, existing_objects, self.server, plan)
+
+        async def create_dashboard(operation):
+            dash = existing.find_dashboard(operation['name'])
+            if dash is not None:
+                print('dashboard {} is already in the server'.format(operation['name']), flush=True)
+                done['skipped'] += 1
+                return operation['name'], dash['id']
+            print('Creating dashboard: ', operation['name'], flush=True)
+            dash = await self.Create_Dashboard(operation['name'])
+            done['create_dashboard'] += 1
+            return operation['name'], dash['id']
+
+        dashboard_ids = dict(await asyncio.gather(*[create_dashboard(operation) for operation in plan['dashboards']]))
+
+        async def apply_query(query_plan):
+            chain = new_chain(query_plan)
+            for operation in query_plan['operations']:
+                if already_done(existing, operation, chain):
+                    done['skipped'] += 1
+                    continue
+                method, path, payload = operation_request(self.server, operation, chain, dashboard_ids)
+                response = await self.request_json(method, path, json=payload)
+                operation_done(self.server, operation, response, chain)
+                done[operation['op']] += 1
+
+        await asyncio.gather(*[apply_query(query_plan) for query_plan in plan['queries']])
+
+        async def archive_query(operation):
+            if live_ids is not None and operation['id'] not in live_ids:
+                print('query {} is already archived'.format(operation['id']), flush=True)
+                done['skipped'] += 1
+                return
+            print('deleting query ' + str(operation['id']), flush=True)
+            await self.request_json('DELETE', '{}/api/queries/{}'.format(self.url, operation['id']))
+            done['archive_query'] += 1
+
+        await asyncio.gather(*[archive_query(operation) for operation in plan['archive']])
+        if self.cache is not None:
+            self.cache.save()
+        return done
+
+    async def Put_Queries(self, old_queries, new_queries):
+        """
+            Upload the queries (and their visualizations and widgets) to the server. Only what changed is sent.
+            Returns the counter of operations done
+        """
+        plan = make_plan(self.url, old_queries, await self.Get_Dashboards(), new_queries)
+        done = await self.Apply_Plan(plan, fresh=True)
+        if not done:
+            print('Nothing to do', flush=True)
+        for op in sorted(done):
+            print('{}: {}'.format(op, done[op]), flush=True)
+        return done
+
+    async def Get_Users(self):
+        """
+            Get all the users. After the first page we know how many there are, so the rest are requested at the same time
+        """
+        path = "{}/api/users".format(self.url)
+        first = await self.request_json('GET', path, params={'page': 1, 'page_size': USERS_PAGE_SIZE})
+        if isinstance(first, list):
+            return first  # old redash versions return all of them without pages
+        rest = await asyncio.gather(*[self.request_json('GET', path, params={'page': page, 'page_size': first['page_size']})
+                                      for page in remaining_pages(first)])
+        users = list(first['results'])
+        for response in rest:
+            users.extend(response['results'])
+        return users
+
+    async def Create_Users(self, users):
+        """
+            Create the users (dicts with `name` and `email`) that are not in the server yet, concurrently.
+            The users are read as they are created, so they can come from a stream.
+            Check Redash.Create_Users. Returns the report of created, skipped and failed
+        """
+        path = "{}/api/users".format(self.url)
+        known_emails = set(user['email'].lower() for user in await self.Get_Users() if user.get('email'))
+        report = Counter()
+
+        async def create_user(user):
+            report[user_created(user, await self.request('POST', path, json=user))] += 1
+
+        await self.for_each(create_user, new_users(users, known_emails, report))
+        print_users_report(report)
+        return report
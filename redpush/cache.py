@@ -0,0 +1,87 @@
+"""
+    Local cache of the objects downloaded from a redash server, so we only download again the ones that changed
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+
+
+def cache_stamp(item):
+    """
+        What tells us if an object changed in the server, from the cheap listing of the objects.
+        None if the listing doesn't have it, then the object cannot be cached
+    """
+    if 'version' not in item and 'updated_at' not in item:
+        return None
+    return [item.get('version'), item.get('updated_at')]
+
+
+class StateCache:
+    """
+        JSON file (one per server url) with the last seen queries and dashboards details, together with the
+        `version`/`updated_at` they had in the listing. If the listing still shows the same stamp, the details
+        stored in the cache are used instead of requesting them again.
+        Redash doesn't change the query/dashboard stamp when only visuals or widgets change, so whoever changes
+        those needs to invalidate the entry.
+        With refresh nothing is taken from the cache, everything is downloaded (and stored for the next runs):
+        the commands that compare against the server need it, as they can't miss a change done in the UI
+    """
+
+    def __init__(self, directory, url, refresh=False):
+        self.url = url
+        self.refresh = refresh
+        self.path = os.path.join(directory, hashlib.sha1(url.encode('utf-8')).hexdigest()[:16] + '.json')
+        self.lock = threading.Lock()
+        self.data = {'url': url, 'queries': {}, 'dashboards': {}}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as stream:
+                    data = json.load(stream)
+                if data.get('url') == url:
+                    self.data = data
+            except ValueError:
+                print('Ignoring corrupted cache ' + self.path)
+
+    def get(self, kind, key, stamp):
+        """
+            The cached details of the object, or None if not there or if it changed since
+        """
+        if stamp is None or self.refresh:
+            return None
+        entry = self.data[kind].get(str(key))
+        if entry is None or entry['stamp'] != stamp:
+            return None
+        return copy.deepcopy(entry['data'])  # callers modify what we return
+
+    def put(self, kind, key, stamp, data):
+        if stamp is None:
+            return
+        with self.lock:
+            self.data[kind][str(key)] = {'stamp': stamp, 'data': copy.deepcopy(data)}
+
+    def invalidate(self, kind, key):
+        with self.lock:
+            self.data[kind].pop(str(key), None)
+
+    def prune(self, kind, keys):
+        """
+            Remove the objects not in keys (deleted from the server)
+        """
+        keys = set(str(key) for key in keys)
+        with self.lock:
+            self.data[kind] = {key: entry for key, entry in self.data[kind].items() if key in keys}
+
+    def save(self):
+        """
+            Write the cache to disk. It goes first to a temp file so we never leave a half written cache
+        """
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        tmp_path = self.path + '.tmp'
+        with self.lock:
+            with open(tmp_path, 'w') as stream:
+                json.dump(self.data, stream, default=str)
+        os.replace(tmp_path, self.path)
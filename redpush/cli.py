@@ -4,135 +4,285 @@
 """
 import click
 import requests
+import cProfile
 import csv
-from ruamel import yaml
-import difflib
 import sys
-from ruamel.yaml.compat import StringIO
-from operator import itemgetter
-from redpush import redash
+from redpush import redash, stats
+from redpush.async_redash import AsyncRedash
+from redpush.cache import StateCache
+from redpush.diff import diff_queries, FORMATTERS
+from redpush.repository import save_yaml, save_yaml_stream, save_yaml_dir, read_queries, FORMATS
+from redpush.index import check_duplicate_ids
+from redpush.journal import Journal
+from redpush.plan import make_plan, print_plan, save_plan, read_plan, apply_plan
+from redpush.targets import read_targets, push_targets, format_report
+from redpush.warmup import warm_up as run_warm_up, print_warm_up
+from redpush.watch import Watcher
 
-def save_yaml(queries, filename):
+def open_cache(cache_dir, redash_url, refresh=False):
     """
-        Save the queries into yaml
+        The state cache for the server, if a cache directory was given.
+        The commands that compare against the server (or change it) refresh it instead of reading it: the
+        cache can't tell when a visualization or widget was changed in the UI
     """
-    stream = open(filename, 'w')
-    yaml.scalarstring.walk_tree(queries)
-    yaml.dump(queries, stream,Dumper=yaml.RoundTripDumper)
-    stream.close()
+    if cache_dir is None:
+        return None
+    return StateCache(cache_dir, redash_url, refresh)
 
-def read_yaml(filename):
+def read_users(csvfile):
     """
-        Load the queries from a yaml file
+        Read the users from the csv, row by row as they are needed
     """
-    file = open(filename, 'r')
-    contents = yaml.load(file, yaml.RoundTripLoader)
-    file.close()
-    return contents
+    reader = csv.reader(csvfile, delimiter=',')
+    for row in reader:
+        if len(row) < 3 or not row[2].strip():
+            print('Ignoring invalid user row {}: {}'.format(reader.line_num, ','.join(row)))
+            continue
+        yield {'name': row[0] + ' ' + row[1], 'email': row[2].strip()}
 
-def sort_queries(queries):
+def make_async_server(redash_url, api_key, concurrency, cache_dir, refresh=False):
+    return AsyncRedash(redash_url, api_key, concurrency, cache=open_cache(cache_dir, redash_url, refresh))
+
+def get_full_queries(async_server):
     """
-        Sort the list of queries so we can compare them easily afterwards
+        All the queries, with their visualizations, using the async client
     """
-    # First short queries per id
-    queries = sorted(queries, key=itemgetter('redpush_id'))
-    # then each query, sort the properties alphabetically 
-    sorted_keys = [] 
-    for item in queries:
-        my_sorted_dict = {}   
-        for k in sorted(item):
-            my_sorted_dict[k] = item[k]
-        sorted_keys.append(my_sorted_dict)
-    return sorted_keys
+    return async_server.run(async_server.Get_Server_State())
 
 @click.group()
-def cli():
-    pass
+@click.option('--stats', 'stats_format', envvar='REDPUSH_STATS', type=click.Choice(sorted(stats.FORMATTERS)),
+              help="At the end, show the requests per endpoint (count, latency, bytes, retries, errors) and where the time went")
+@click.option('--stats-file', help="Write the stats to this file instead of stderr", type=str)
+@click.option('--trace', is_flag=True, default=False, help="Print every request to the server (and its time) as it is done")
+@click.option('--profile', 'profile_file', help="Save a cProfile of the main thread to this file, for pstats/snakeviz. The downloads and the filtering of the server objects run in worker threads and are not in it (--stats has their time)", type=str)
+@click.pass_context
+def cli(ctx, stats_format, stats_file, trace, profile_file):
+    if stats_format or trace:
+        stats.recorder.start(trace)
+    profiler = None
+    # only the main thread is profiled: the worker threads of the pipelines would need a profiler each
+    if profile_file:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def report():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(profile_file)
+        if stats_format:
+            output = stats.FORMATTERS[stats_format](stats.recorder.report())
+            if stats_file:
+                with open(stats_file, 'w') as stream:
+                    stream.write(output)
+            else:
+                click.echo(output, err=True, nl=False)
+    ctx.call_on_close(report)
 
 @cli.command()
 @click.option('--redash-url',envvar='REDASH_URL')
 @click.option('--api-key',envvar='REDASH_KEY', help="API Key")
 @click.option('-o', '--out-file', help="File to store the queries", type=str)
-def dump(redash_url, api_key, out_file):
-    if out_file is None:
+@click.option('--out-dir', help="Directory to store the queries, one file per query", type=str)
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--cache-dir', envvar='REDPUSH_CACHE_DIR', help="Directory to cache the server state between runs", type=str)
+@click.option('--async', 'use_async', is_flag=True, default=False, help="Use the asyncio client, pipelining the requests of different queries")
+@click.option('--format', 'output_format', type=click.Choice(FORMATS), help="Format of the files (by default, from the extension of the out file, or yaml)")
+def dump(redash_url, api_key, out_file, out_dir, concurrency, cache_dir, use_async, output_format):
+    if out_file is None and out_dir is None:
         click.echo('No out file provided')
         return
-    server = redash.Redash(redash_url, api_key)
-    queries = server.Get_Queries()
-    queries = server.Get_Full_Queries(queries)
-    
-    save_yaml(queries, out_file)
+    if use_async:
+        queries = get_full_queries(make_async_server(redash_url, api_key, concurrency, cache_dir))
+    else:
+        server = redash.Redash(redash_url, api_key, concurrency, cache=open_cache(cache_dir, redash_url))
+        queries = server.Iter_Server_State()
+
+    if out_dir is not None:
+        save_yaml_dir(queries, out_dir, output_format or 'yaml')
+    else:
+        save_yaml_stream(queries, out_file, output_format)
 
 @cli.command()
 @click.option('--redash-url',envvar='REDASH_URL')
 @click.option('--api-key',envvar='REDASH_KEY', help="API Key")
-@click.option('-i', '--in-file', help="File to read the queries from", type=str)
-def push(redash_url, api_key, in_file):
+@click.option('-i', '--in-file', help="File (or directory of files) to read the queries from", type=str)
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--cache-dir', envvar='REDPUSH_CACHE_DIR', help="Directory to cache the parsed files between runs (the server state is always downloaded, and cached for dump)", type=str)
+@click.option('--async', 'use_async', is_flag=True, default=False, help="Use the asyncio client, pipelining the requests of different queries")
+@click.option('--targets', 'targets_file', help="File with the servers to push to (instead of --redash-url and --api-key), all at the same time", type=str)
+@click.option('--parallel-targets', help="Max servers to push to at the same time (by default all)", type=int)
+@click.option('--warm-up', is_flag=True, default=False, help="After the push, run the queries created or changed (or with new widgets)")
+@click.option('--warm-up-per-source', default=2, help="Max queries running at the same time in each data source", type=int)
+@click.option('--warm-up-timeout', default=300, help="Seconds to wait for each query to run", type=int)
+@click.option('--journal', 'journal_file', envvar='REDPUSH_JOURNAL', help="File to record what is pushed, so a failed push can be resumed", type=str)
+@click.option('--resume', is_flag=True, default=False, help="Continue the failed push recorded in the journal, without repeating what it did")
+@click.option('--discard-journal', is_flag=True, default=False, help="Start a new push even if the journal has one that didn't finish")
+def push(redash_url, api_key, in_file, concurrency, cache_dir, use_async, targets_file, parallel_targets, warm_up,
+         warm_up_per_source, warm_up_timeout, journal_file, resume, discard_journal):
     
     if in_file is None:
         click.echo('No file provided')
         return
-    server = redash.Redash(redash_url, api_key)
-    old_queries = server.Get_Queries()
-    old_queries = server.Get_Full_Queries(old_queries)
+    if warm_up and (use_async or targets_file):
+        raise click.ClickException('--warm-up can only be used when pushing to one server without --async')
+    if journal_file and (use_async or targets_file):
+        raise click.ClickException('--journal can only be used when pushing to one server without --async')
+    if resume and not journal_file:
+        raise click.ClickException('--resume needs the --journal of the push to resume')
+    if resume and discard_journal:
+        raise click.ClickException('--resume and --discard-journal can\'t be used together')
+    targets = read_targets(targets_file) if targets_file else None
+    new = read_queries(in_file, cache_dir)
+    check_duplicate_ids(new)  # before spending time downloading from the server
 
-    new = read_yaml(in_file)
-    server.Put_Queries(old_queries, new)
+    if targets is not None:
+        # the files are read and checked once for all the servers
+        results = push_targets(targets, new, concurrency, cache_dir, parallel_targets)
+        click.echo(format_report(results))
+        failed = [result['name'] for result in results if result['error']]
+        if failed:
+            raise click.ClickException('Push failed for {}'.format(', '.join(failed)))
+        return
+
+    if use_async:
+        server = make_async_server(redash_url, api_key, concurrency, cache_dir, refresh=True)
+        old_queries = get_full_queries(server)
+        server.run(server.Put_Queries(old_queries, new))
+        return
+
+    journal = Journal(journal_file, redash_url, resume, discard_journal) if journal_file else None
+    server = redash.Redash(redash_url, api_key, concurrency, cache=open_cache(cache_dir, redash_url, refresh=True), journal=journal)
+    old_queries = server.Iter_Server_State()  # they go straight to the index of Put_Queries
+
+    try:
+        summary = server.Put_Queries(old_queries, new)
+    except BaseException:
+        if journal is not None:
+            journal.close()
+            print('Push failed, run it again with --resume to continue from where it stopped', flush=True)
+        raise
+    if journal is not None:
+        journal.close(finished=True)
+    if warm_up:
+        print_warm_up(run_warm_up(server, summary['changed_queries'], warm_up_per_source, warm_up_timeout))
  
 @cli.command()
 @click.option('--redash-url',envvar='REDASH_URL')
 @click.option('--api-key',envvar='REDASH_KEY', help="API Key")
-@click.option('-i', '--in-file', help="File to read the queries from", type=str)
-def archive(redash_url, api_key, in_file):
+@click.option('-i', '--in-file', help="File (or directory of files) to watch", type=str)
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--cache-dir', envvar='REDPUSH_CACHE_DIR', help="Directory to store the server state read at the start, for the next dump (the parsed files are kept in memory, not there)", type=str)
+@click.option('--interval', default=0.5, help="Seconds between checks of the files", type=float)
+def watch(redash_url, api_key, in_file, concurrency, cache_dir, interval):
+    if in_file is None:
+        click.echo('No file provided')
+        return
+    server = redash.Redash(redash_url, api_key, concurrency, cache=open_cache(cache_dir, redash_url, refresh=True))
+    Watcher(server, in_file).run(interval)
+ 
+@cli.command()
+@click.option('--redash-url',envvar='REDASH_URL')
+@click.option('--api-key',envvar='REDASH_KEY', help="API Key")
+@click.option('-i', '--in-file', help="File (or directory of files) to read the queries from", type=str)
+@click.option('-o', '--out-file', help="File to store the plan", type=str)
+@click.option('--archive/--no-archive', default=False, help="Plan also to archive the queries not in the file")
+@click.option('--max-deletions', help="With --archive, fail if more than this number of queries would be archived", type=int)
+@click.option('--max-percentage', default=50.0, help="With --archive, fail if more than this % of the server queries would be archived", type=float)
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--cache-dir', envvar='REDPUSH_CACHE_DIR', help="Directory to cache the parsed files between runs (the server state is always downloaded, and cached for dump)", type=str)
+def plan(redash_url, api_key, in_file, out_file, archive, max_deletions, max_percentage, concurrency, cache_dir):
+    if in_file is None or out_file is None:
+        click.echo('No file provided')
+        return
+    new = read_queries(in_file, cache_dir)
+    check_duplicate_ids(new)
+
+    server = redash.Redash(redash_url, api_key, concurrency, cache=open_cache(cache_dir, redash_url, refresh=True))
+    old_queries = list(server.Iter_Server_State())
+
+    changes = make_plan(redash_url, old_queries, server.Get_Dashboards(), new, archive, max_deletions, max_percentage)
+    save_plan(changes, out_file)
+    print_plan(changes)
+
+@cli.command()
+@click.option('--redash-url',envvar='REDASH_URL')
+@click.option('--api-key',envvar='REDASH_KEY', help="API Key")
+@click.option('-i', '--in-file', help="File with the plan to apply", type=str)
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--cache-dir', envvar='REDPUSH_CACHE_DIR', help="Directory to cache the server state between runs", type=str)
+def apply(redash_url, api_key, in_file, concurrency, cache_dir):
+    if in_file is None:
+        click.echo('No file provided')
+        return
+    changes = read_plan(in_file)
+    if changes['server'] != redash_url:
+        raise click.ClickException('The plan was made for {}, not for {}'.format(changes['server'], redash_url))
+
+    server = redash.Redash(redash_url, api_key, concurrency, cache=open_cache(cache_dir, redash_url))
+    done = apply_plan(server, changes)
+    for op in sorted(done):
+        click.echo('{}: {}'.format(op, done[op]))
+
+@cli.command()
+@click.option('--redash-url',envvar='REDASH_URL')
+@click.option('--api-key',envvar='REDASH_KEY', help="API Key")
+@click.option('-i', '--in-file', help="File (or directory of files) to read the queries from", type=str)
+@click.option('--cache-dir', envvar='REDPUSH_CACHE_DIR', help="Directory to cache the parsed files between runs", type=str)
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--max-deletions', help="Don't archive anything if more than this number of queries would be archived", type=int)
+@click.option('--max-percentage', default=50.0, help="Don't archive anything if more than this % of the server queries would be archived", type=float)
+@click.option('--dry-run', is_flag=True, default=False, help="Only list the queries that would be archived")
+def archive(redash_url, api_key, in_file, cache_dir, concurrency, max_deletions, max_percentage, dry_run):
     
     if in_file is None:
         click.echo('No file provided')
         return
-    server = redash.Redash(redash_url, api_key)
-    server_queries = server.Get_Queries(True)
+    new = read_queries(in_file, cache_dir)
 
-    new = read_yaml(in_file)
-    server.Archive_Missing_Queries(server_queries, new)
+    server = redash.Redash(redash_url, api_key, concurrency)
+    server_queries = server.Get_Queries(True)
+    server.Archive_Missing_Queries(server_queries, new, max_deletions, max_percentage, dry_run)
  
 @cli.command()
 @click.option('--redash-url',envvar='REDASH_URL')
 @click.option('--api-key',envvar='REDASH_KEY', help="API Key")
-@click.option('-i', '--in-file', help="File to read the queries from", type=str)
-def diff(redash_url, api_key, in_file):
+@click.option('-i', '--in-file', help="File (or directory of files) to read the queries from", type=str)
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--cache-dir', envvar='REDPUSH_CACHE_DIR', help="Directory to cache the parsed files between runs (the server state is always downloaded, and cached for dump)", type=str)
+@click.option('--format', 'output_format', type=click.Choice(sorted(FORMATTERS)), default='text', help="Output format of the diff")
+@click.option('--dashboards/--no-dashboards', default=True, help="Compare also the widgets positions in the dashboards")
+@click.option('--async', 'use_async', is_flag=True, default=False, help="Use the asyncio client, pipelining the requests of different queries")
+def diff(redash_url, api_key, in_file, concurrency, cache_dir, output_format, dashboards, use_async):
     
     if in_file is None:
         click.echo('No file provided')
         return
-    server = redash.Redash(redash_url, api_key)
-    old_queries = server.Get_Queries()
-    old_queries = server.Get_Full_Queries(old_queries)
-    old_sorted_queries = sort_queries(old_queries)
-
-    old_stream = StringIO()
-    yaml.scalarstring.walk_tree(old_sorted_queries)
-    yaml.dump(old_sorted_queries, old_stream,Dumper=yaml.RoundTripDumper) 
+    new_queries = read_queries(in_file, cache_dir)
 
-    new_queries = read_yaml(in_file)
-    new_sorted_queries = sort_queries(new_queries)
+    if use_async:
+        server = make_async_server(redash_url, api_key, concurrency, cache_dir, refresh=True)
+        old_queries = get_full_queries(server)
+        dash_list = server.run(server.Get_Dashboards()) if dashboards else None
+    else:
+        server = redash.Redash(redash_url, api_key, concurrency, cache=open_cache(cache_dir, redash_url, refresh=True))
+        dash_list = server.Get_Dashboards() if dashboards else None
+        # the queries are compared as they arrive, we don't keep them
+        old_queries = server.Iter_Server_State()
 
-    new_stream = StringIO()
-    yaml.scalarstring.walk_tree(new_sorted_queries)
-    yaml.dump(new_sorted_queries, new_stream,Dumper=yaml.RoundTripDumper) 
-
-    # diff = difflib.ndiff(old_stream.getvalue().strip().splitlines(),new_stream.getvalue().strip().splitlines())
-    diff = difflib.HtmlDiff().make_file(old_stream.getvalue().strip().splitlines(),new_stream.getvalue().strip().splitlines(), "test.html")
-    sys.stdout.writelines(diff)
+    changes = diff_queries(old_queries, new_queries, dash_list)
+    sys.stdout.write(FORMATTERS[output_format](changes))
 
 
 @cli.command()
 @click.option('--redash-url',envvar='REDASH_URL')
 @click.option('--api-key',envvar='REDASH_KEY', help="API Key")
 @click.option('-o', '--out-file', help="File to store the queries", type=str)
-def dashboards(redash_url, api_key, out_file):
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+def dashboards(redash_url, api_key, out_file, concurrency):
     if out_file is None:
         click.echo('No out file provided')
         return
-    server = redash.Redash(redash_url, api_key)
+    server = redash.Redash(redash_url, api_key, concurrency)
     dashboards = server.Get_Dashboards()
 
     save_yaml(dashboards, out_file)
@@ -141,22 +291,23 @@ def dashboards(redash_url, api_key, out_file):
 @click.option('--redash-url',envvar='REDASH_URL')
 @click.option('--api-key',envvar='REDASH_KEY', help="API Key")
 @click.option('-i', '--in-file', help="File (csv) to read users from. CSV format='name,lastname,email'", type=str)
-def users(redash_url, api_key, in_file):
+@click.option('--concurrency', envvar='REDPUSH_CONCURRENCY', default=8, help="Max parallel requests to the server", type=int)
+@click.option('--async', 'use_async', is_flag=True, default=False, help="Use the asyncio client")
+def users(redash_url, api_key, in_file, concurrency, use_async):
     if in_file is None:
         click.echo('No file provided')
         return
-    
-    users = []
-    with open(in_file) as csvfile:
-        reader = csv.reader(csvfile, delimiter=',')
-        for row in reader:
-                user = {'name': row[0] + ' ' + row[1], 'email': row[2]}   # TODO validation
-                users.append(user)
 
-    server = redash.Redash(redash_url, api_key)
+    if use_async:
+        server = make_async_server(redash_url, api_key, concurrency, None)
+        with open(in_file) as csvfile:
+            server.run(server.Create_Users(read_users(csvfile)))
+        return
 
-    dashboards = server.Create_Users(users)
+    server = redash.Redash(redash_url, api_key, concurrency)
 
+    with open(in_file) as csvfile:
+        server.Create_Users(read_users(csvfile))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,212 @@
+"""
+    Structural diff between the queries in a redash server and the ones in the yaml files.
+    Objects are matched by their redpush_id and compared field by field, so only what changed is reported
+"""
+import difflib
+import html
+import json
+from redpush.index import RedpushIndex
+from redpush.layout import DashboardLayout
+from redpush.redash import NOT_CONTENT_FIELDS, POSITION_FIELDS
+
+
+def diff_values(field, server_value, file_value, fields):
+    """
+        Compare two values and append to fields the differences found, going into dicts (and lists of
+        the same length) so we point to the exact property that changed
+    """
+    if server_value == file_value:
+        return
+    if isinstance(server_value, dict) and isinstance(file_value, dict):
+        for key in sorted(set(server_value) | set(file_value), key=str):
+            diff_values('{}.{}'.format(field, key), server_value.get(key), file_value.get(key), fields)
+    elif isinstance(server_value, list) and isinstance(file_value, list) and len(server_value) == len(file_value):
+        for position, (server_item, file_item) in enumerate(zip(server_value, file_value)):
+            diff_values('{}[{}]'.format(field, position), server_item, file_item, fields)
+    else:
+        fields.append({'field': field, 'server': server_value, 'file': file_value})
+
+
+def diff_object(server_item, file_item):
+    """
+        The fields that are different between the server and the file object. Only the fields in the file
+        are compared, as those are the ones that push sends
+    """
+    fields = []
+    for key in file_item:
+        if key not in NOT_CONTENT_FIELDS:
+            diff_values(key, server_item.get(key), file_item[key], fields)
+    return fields
+
+
+def change(kind, label, status, fields=None):
+    return {'kind': kind, 'object': label, 'status': status, 'fields': fields or []}
+
+
+def diff_queries(server_queries, file_queries, dashboards=None):
+    """
+        Compare the (full) queries from the server against the ones from the file.
+        If the server dashboards are given, the position of the widgets is compared too.
+        server_queries can be an iterator: each one is compared as it comes and then dropped, so we never
+        need all of them in memory. The changes follow the order of the server, and then the queries added
+        by the file.
+        Returns the list of changes, each one the kind of object, a label, the status (added, removed or changed)
+        and the fields that changed
+    """
+    index = RedpushIndex((), dashboards or [])
+    layout = DashboardLayout(file_queries) if dashboards is not None else None
+    file_index = {}
+    for file_query in file_queries:
+        if 'redpush_id' in file_query:
+            file_index.setdefault(file_query['redpush_id'], file_query)
+    changes = []
+
+    seen = set()
+    for server_query in server_queries:
+        redpush_id = server_query.get('redpush_id')
+        if redpush_id in seen:
+            continue  # repeated in the server, only the first one is used
+        if redpush_id not in file_index:
+            label = 'query {} ({})'.format(server_query.get('redpush_id', 'id ' + str(server_query.get('id'))), server_query.get('name'))
+            changes.append(change('query', label, 'removed'))
+            continue
+        seen.add(redpush_id)
+        diff_query(changes, index, layout, server_query, file_index[redpush_id])
+
+    for redpush_id, file_query in file_index.items():
+        if redpush_id not in seen:
+            diff_query(changes, index, layout, None, file_query)
+    return changes
+
+
+def diff_query(changes, index, layout, server_query, file_query):
+    """
+        Append to changes the differences of a query (None if not in the server) and its visualizations.
+        The widgets are compared only if there is a layout
+    """
+    redpush_id = file_query['redpush_id']
+    label = 'query {} ({})'.format(redpush_id, file_query.get('name'))
+    if server_query is None:
+        changes.append(change('query', label, 'added'))
+    else:
+        fields = diff_object(server_query, file_query)
+        if fields:
+            changes.append(change('query', label, 'changed', fields))
+
+    server_visuals = {}
+    if server_query is not None:
+        for server_visual in server_query.get('visualizations') or []:
+            server_visuals.setdefault(server_visual.get('redpush_id'), server_visual)
+
+    file_visual_ids = set()
+    for file_visual in file_query.get('visualizations') or []:
+        if 'redpush_id' not in file_visual:
+            continue
+        file_visual_ids.add(file_visual['redpush_id'])
+        visual_label = 'query {} visualization {} ({})'.format(redpush_id, file_visual['redpush_id'], file_visual.get('name'))
+        server_visual = server_visuals.get(file_visual['redpush_id'])
+        if server_visual is None:
+            changes.append(change('visualization', visual_label, 'added'))
+        else:
+            fields = diff_object(server_visual, file_visual)
+            if fields:
+                changes.append(change('visualization', visual_label, 'changed', fields))
+        if layout is not None:
+            changes.extend(diff_widgets(index, layout, visual_label, redpush_id, server_visual, file_visual))
+
+    for visual_id, server_visual in server_visuals.items():
+        if visual_id not in file_visual_ids:
+            visual_label = 'query {} visualization {} ({})'.format(redpush_id, visual_id, server_visual.get('name'))
+            changes.append(change('visualization', visual_label, 'removed'))
+
+
+def diff_widgets(index, layout, visual_label, query_redpush_id, server_visual, file_visual):
+    """
+        Compare where the file wants the visualization in the dashboards against where it is
+    """
+    changes = []
+    for widget_properties in file_visual.get('redpush_dashboards') or []:
+        label = '{} widget in {}'.format(visual_label, widget_properties['name'])
+        dash = index.find_dashboard(widget_properties['name'])
+        widget = None
+        if dash is not None and server_visual is not None:
+            widget = index.find_widget(dash, server_visual['id'])
+        if widget is None:
+            changes.append(change('widget', label, 'added'))
+            continue
+        current = widget.get('options', {}).get('position', {})
+        position = layout.position(widget_properties['name'], query_redpush_id, file_visual['redpush_id'], widget_properties)
+        fields = []
+        for key in POSITION_FIELDS:
+            diff_values('position.' + key, current.get(key), position.get(key), fields)
+        if fields:
+            changes.append(change('widget', label, 'changed', fields))
+    return changes
+
+
+STATUS_SIGNS = {'added': '+', 'removed': '-', 'changed': '~'}
+
+
+def format_value_lines(value):
+    if isinstance(value, str):
+        return value.splitlines() or ['']
+    return json.dumps(value, sort_keys=True, default=str).splitlines()
+
+
+def format_text(changes):
+    lines = []
+    for item in changes:
+        lines.append('{} {}'.format(STATUS_SIGNS[item['status']], item['object']))
+        for field in item['fields']:
+            server_lines = format_value_lines(field['server'])
+            file_lines = format_value_lines(field['file'])
+            if len(server_lines) > 1 or len(file_lines) > 1:
+                lines.append('    {}:'.format(field['field']))
+                for line in difflib.unified_diff(server_lines, file_lines, 'server', 'file', lineterm='', n=1):
+                    lines.append('      ' + line)
+            else:
+                lines.append('    {}: {} -> {}'.format(field['field'], server_lines[0], file_lines[0]))
+    if not changes:
+        lines.append('No differences')
+    return '\n'.join(lines) + '\n'
+
+
+def format_json(changes):
+    return json.dumps(changes, indent=2, default=str) + '\n'
+
+
+def format_html(changes):
+    rows = []
+    for item in changes:
+        rows.append('<tr class="{0}"><td>{1}</td><td colspan="3">{2}</td></tr>'.format(
+            item['status'], STATUS_SIGNS[item['status']], html.escape(item['object'])))
+        for field in item['fields']:
+            rows.append('<tr><td></td><td>{}</td><td><pre>{}</pre></td><td><pre>{}</pre></td></tr>'.format(
+                html.escape(field['field']),
+                html.escape('\n'.join(format_value_lines(field['server']))),
+                html.escape('\n'.join(format_value_lines(field['file'])))))
+    return '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>redpush diff</title>
+<style>
+td {{ vertical-align: top; font-family: monospace; }}
+.added {{ background: #aaffaa; }} .removed {{ background: #ffaaaa; }} .changed {{ background: #ffff77; }}
+</style>
+</head>
+<body>
+<table>
+<tr><th></th><th>field</th><th>server</th><th>file</th></tr>
+{}
+</table>
+</body>
+</html>
+'''.format('\n'.join(rows))
+
+
+FORMATTERS = {
+    'text': format_text,
+    'json': format_json,
+    'html': format_html,
+}
@@ -0,0 +1,111 @@
+"""
+    In memory indexes of the redash objects, so we don't need to scan lists to find them
+"""
+import click
+
+
+class RedpushIndex:
+    """
+        Index of the server objects, built once per run and updated as we create new objects:
+        - queries by redpush_id
+        - visualizations by (query redpush_id, visualization redpush_id)
+        - dashboards by name
+        - widgets by (dashboard id, visualization id)
+        When there are repeated keys the first object is the one indexed, as the linear searches did before
+    """
+
+    def __init__(self, queries=(), dashboards=()):
+        self.queries = {}
+        self.visualizations = {}
+        self.dashboards = {}
+        self.widgets = {}
+        for query in queries:
+            self.add_query(query)
+        for dashboard in dashboards:
+            self.add_dashboard(dashboard)
+
+    def add_query(self, query):
+        """
+            Index a query (with a top level redpush_id) and its visualizations
+        """
+        if 'redpush_id' not in query:
+            return
+        redpush_id = query['redpush_id']
+        if redpush_id in self.queries:
+            print('There are repeated queries with redpush_id {} in the server. Using the first'.format(redpush_id))
+            return
+        self.queries[redpush_id] = query
+        for visualization in query.get('visualizations') or []:
+            self.add_visualization(query, visualization)
+
+    def add_visualization(self, query, visualization):
+        if 'redpush_id' not in visualization:
+            return
+        key = (query['redpush_id'], visualization['redpush_id'])
+        if key in self.visualizations:
+            print('There are repeated visuals. Using the first')
+            return
+        self.visualizations[key] = visualization
+
+    def add_dashboard(self, dashboard):
+        """
+            Index a dashboard and its widgets
+        """
+        if dashboard['name'] in self.dashboards:
+            print('More than one dashboard with the same id, error!!!')
+            return
+        self.dashboards[dashboard['name']] = dashboard
+        for widget in dashboard.get('widgets') or []:
+            self.add_widget(dashboard, widget)
+
+    def add_widget(self, dashboard, widget):
+        if 'visualization' not in widget:
+            return  # text widgets
+        self.widgets.setdefault((dashboard['id'], widget['visualization']['id']), widget)
+
+    def find_query(self, redpush_id):
+        return self.queries.get(redpush_id)
+
+    def find_visualization(self, query, redpush_id):
+        if query is None:
+            return None
+        return self.visualizations.get((query['redpush_id'], redpush_id))
+
+    def find_dashboard(self, name):
+        return self.dashboards.get(name)
+
+    def find_widget(self, dashboard, visualization_id):
+        return self.widgets.get((dashboard['id'], visualization_id))
+
+
+def find_duplicate_ids(queries):
+    """
+        Find the redpush_ids repeated in a list of queries (from the file).
+        Returns a list of messages describing each repeated query id, or visualization id inside a query
+    """
+    errors = []
+    seen_queries = set()
+    for query in queries:
+        if 'redpush_id' not in query:
+            continue
+        redpush_id = query['redpush_id']
+        if redpush_id in seen_queries:
+            errors.append('query redpush_id {} is repeated'.format(redpush_id))
+        seen_queries.add(redpush_id)
+        seen_visuals = set()
+        for visualization in query.get('visualizations') or []:
+            if 'redpush_id' not in visualization:
+                continue
+            if visualization['redpush_id'] in seen_visuals:
+                errors.append('visualization redpush_id {} is repeated in query {}'.format(visualization['redpush_id'], redpush_id))
+            seen_visuals.add(visualization['redpush_id'])
+    return errors
+
+
+def check_duplicate_ids(queries):
+    """
+        Stop if there are repeated redpush_ids in the queries, as we wouldn't know which object to update
+    """
+    errors = find_duplicate_ids(queries)
+    if errors:
+        raise click.ClickException('Repeated redpush_id found:\n  ' + '\n  '.join(errors))
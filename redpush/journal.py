@@ -0,0 +1,85 @@
+"""
+    Journal of what a push already did in the server, so a push that failed in the middle can be resumed
+"""
+import json
+import os
+import threading
+import click
+
+
+def journal_key(*parts):
+    return json.dumps(parts)
+
+
+class Journal:
+    """
+        Append only JSON lines file with the operations done by a push: the dashboards, queries,
+        visualizations and widgets created or updated, with the id the server gave them and what was sent.
+        Each line is written (and flushed) as soon as the server answered, so if the process dies we know
+        what reached the server.
+        When resuming, the operations already done with the same content are not sent again, and the ids
+        recorded are used for the objects the server listing doesn't show (so they are not created twice)
+        The journal is removed when the push finishes, so if it is there, that push didn't finish: it is only
+        replaced if we are told to discard it
+    """
+
+    def __init__(self, path, url, resume=False, discard=False):
+        self.path = path
+        self.url = url
+        self.lock = threading.Lock()
+        self.done = {}
+        if os.path.exists(path) and not resume and not discard:
+            raise click.ClickException('The journal {} is of a push that didn\'t finish. Use --resume to continue it, '
+                                       'or --discard-journal to start a new push and lose what it recorded'.format(path))
+        if resume and os.path.exists(path):
+            self.load()
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.stream = open(path, 'a' if resume else 'w')
+        if not self.done:
+            self.write({'op': 'start', 'url': url})
+
+    def load(self):
+        with open(self.path) as stream:
+            for number, line in enumerate(stream, 1):
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # the last line can be half written if the process died while writing it
+                    print('Ignoring invalid line {} of the journal {}'.format(number, self.path), flush=True)
+                    continue
+                if entry['op'] == 'start':
+                    if entry['url'] != self.url:
+                        raise click.ClickException('The journal {} is of a push to {}, not to {}'.format(self.path, entry['url'], self.url))
+                    continue
+                self.done[journal_key(entry['op'], *entry['key'])] = entry
+        print('Resuming from {}: {} operations already done'.format(self.path, len(self.done)), flush=True)
+
+    def write(self, entry):
+        with self.lock:
+            self.stream.write(json.dumps(entry, sort_keys=True) + '\n')
+            self.stream.flush()
+
+    def record(self, op, key, id, **data):
+        """
+            Record that the object of kind op (query, visualization, dashboard or widget) with the given key
+            (the redpush ids, or the dashboard name) is in the server with that id and data
+        """
+        entry = dict(data, op=op, key=list(key), id=id)
+        self.done[journal_key(op, *key)] = entry
+        self.write(entry)
+
+    def find(self, op, key):
+        """
+            What was recorded for the object, or None
+        """
+        return self.done.get(journal_key(op, *key))
+
+    def close(self, finished=False):
+        """
+            Close the journal. If the push finished there is nothing to resume, so it is removed
+        """
+        self.stream.close()
+        if finished:
+            os.remove(self.path)
@@ -0,0 +1,125 @@
+"""
+    Layout of the dashboards: where each widget of the yaml goes in the grid of redash.
+    All the widgets of a dashboard are placed at the same time, so they can't overlap
+"""
+# width of the grid of redash
+GRID_COLUMNS = 6
+
+
+class WidgetPlacement:
+    """
+        Where the yaml wants a visualization in a dashboard (the items of `redpush_dashboards`):
+        the dashboard name, a row and col and one of the sizes
+    """
+    __slots__ = ('name', 'row', 'col', 'size')
+
+    # the grid of redash is 6 columns wide. The col of the yaml counts widgets of the given size
+    MULTIPLIERS = {'small': 2, 'medium': 3, 'large': 1}
+    SIZE_X = {'small': 2, 'medium': 3, 'large': 6}  # 6 is the max size in redash
+    SIZE_Y = {'small': 5, 'medium': 9, 'large': 12}
+
+    def __init__(self, name, row=0, col=0, size='medium'):
+        self.name = name
+        self.row = row
+        self.col = col
+        self.size = size
+
+    @classmethod
+    def from_yaml(cls, widget_properties):
+        size = widget_properties.get('size') or 'medium'
+        col = widget_properties.get('col') or 0
+        row = widget_properties.get('row') or 0
+        return cls(widget_properties.get('name'), max(row, 0), max(col, 0), size)
+
+    def position(self):
+        """
+            The position properties that redash expects on the API
+        """
+        return {
+            'autoHeight': False,
+            'row': self.row,
+            'col': self.col * self.MULTIPLIERS[self.size],
+            'sizeX': self.SIZE_X[self.size],
+            'sizeY': self.SIZE_Y[self.size],
+        }
+
+
+def overlaps(position, other):
+    return (position['col'] < other['col'] + other['sizeX'] and other['col'] < position['col'] + position['sizeX'] and
+            position['row'] < other['row'] + other['sizeY'] and other['row'] < position['row'] + position['sizeY'])
+
+
+def place_widgets(placements):
+    """
+        The grid positions of the widgets of one dashboard, given their WidgetPlacements.
+        The row of the yaml is the order of the rows of widgets (not a grid row): each row of widgets starts
+        below the lowest widget of the previous one. A widget that would overlap another one (or go out
+        of the grid) is moved down (or left) to the first place where it fits.
+        Returns the positions, in the same order as the placements, and the indexes of the ones that were moved
+    """
+    positions = [None] * len(placements)
+    moved = []
+    placed = []
+    top = 0
+    rows = sorted(set(placement.row for placement in placements))
+    for row in rows:
+        in_row = [i for i, placement in enumerate(placements) if placement.row == row]
+        in_row.sort(key=lambda i: (placements[i].col, i))
+        bottom = top
+        for i in in_row:
+            position = placements[i].position()
+            position['row'] = top
+            position['sizeX'] = min(position['sizeX'], GRID_COLUMNS)
+            if position['col'] + position['sizeX'] > GRID_COLUMNS:
+                position['col'] = GRID_COLUMNS - position['sizeX']
+                moved.append(i)
+            blocking = [other for other in placed if overlaps(position, other)]
+            if blocking and i not in moved:
+                moved.append(i)
+            while blocking:
+                # the first place below the widgets in the way
+                position['row'] = min(other['row'] + other['sizeY'] for other in blocking)
+                blocking = [other for other in placed if overlaps(position, other)]
+            placed.append(position)
+            positions[i] = position
+            bottom = max(bottom, position['row'] + position['sizeY'])
+        top = bottom
+    return positions, moved
+
+
+class DashboardLayout:
+    """
+        The positions of all the widgets the yaml queries put in dashboards, by
+        (dashboard name, query redpush_id, visualization redpush_id)
+    """
+
+    def __init__(self, queries):
+        self.positions = {}
+        dashboards = {}
+        for query in queries:
+            if 'redpush_id' not in query:
+                continue
+            for visualization in query.get('visualizations') or []:
+                if 'redpush_id' not in visualization:
+                    continue
+                for widget_properties in visualization.get('redpush_dashboards') or []:
+                    key = (query['redpush_id'], visualization['redpush_id'])
+                    dashboards.setdefault(widget_properties['name'], []).append((key, WidgetPlacement.from_yaml(widget_properties)))
+
+        for name, widgets in dashboards.items():
+            positions, moved = place_widgets([placement for key, placement in widgets])
+            for (key, placement), position in zip(widgets, positions):
+                self.positions[(name,) + key] = position
+            for i in moved:
+                key = widgets[i][0]
+                print('Widget of query {} visualization {} overlaps with others in {}, placed at row {} col {}'.format(
+                    key[0], key[1], name, positions[i]['row'], positions[i]['col']), flush=True)
+
+    def position(self, dashboard, query_redpush_id, visualization_redpush_id, widget_properties):
+        """
+            Where the widget goes. Widgets not in the layout are placed on their own, as before
+        """
+        position = self.positions.get((dashboard, query_redpush_id, visualization_redpush_id))
+        if position is None:
+            return WidgetPlacement.from_yaml(widget_properties).position()
+        return dict(position)
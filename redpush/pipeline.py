@@ -0,0 +1,81 @@
+"""
+    Streaming pipeline stages, connected by bounded queues.
+    Each stage reads its input in a thread of its own and processes it in worker threads, so all the stages
+    (listing, downloading details, filtering, writing...) run at the same time. As the queues are bounded,
+    a slow stage stops the previous ones instead of piling up items in memory
+"""
+import queue
+import threading
+from concurrent.futures import Future
+
+_DONE = object()
+# how often blocked threads check if the consumer went away
+_POLL_SECONDS = 0.1
+
+
+def stage(function, items, workers=1, buffer=8):
+    """
+        Apply function to each of the items in `workers` threads, yielding the results in the same order
+        as the items. At most `buffer` items are read ahead of what has been consumed.
+        Errors (from function or from reading the items) are raised to the consumer.
+        If the consumer stops early, the threads stop too
+    """
+    work = queue.Queue()
+    ordered = queue.Queue(maxsize=max(1, buffer, workers))
+    stop = threading.Event()
+
+    def put(target, value):
+        while not stop.is_set():
+            try:
+                target.put(value, timeout=_POLL_SECONDS)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def feed():
+        try:
+            for item in items:
+                future = Future()
+                # this blocks when the consumer is `buffer` items behind
+                if not put(ordered, future):
+                    break
+                work.put((future, item))
+        except BaseException as error:
+            future = Future()
+            future.set_exception(error)
+            put(ordered, future)
+        finally:
+            put(ordered, _DONE)
+            for _ in range(workers):
+                work.put(_DONE)
+            if stop.is_set() and hasattr(items, 'close'):
+                items.close()  # let the previous stage know that we don't need more
+
+    def process():
+        while True:
+            task = work.get()
+            if task is _DONE:
+                return
+            future, item = task
+            if stop.is_set():
+                future.cancel()
+                continue
+            try:
+                future.set_result(function(item))
+            except BaseException as error:
+                future.set_exception(error)
+
+    threads = [threading.Thread(target=feed)] + [threading.Thread(target=process) for _ in range(workers)]
+    for thread in threads:
+        thread.daemon = True
+        thread.parent = threading.current_thread()  # so what they print can be told apart, check redpush.targets
+        thread.start()
+    try:
+        while True:
+            future = ordered.get()
+            if future is _DONE:
+                return
+            yield future.result()
+    finally:
+        stop.set()
@@ -0,0 +1,300 @@
+"""
+    Plan of the changes needed to get a redash server to the state of the yaml files, and how to apply it.
+    Making the plan only needs the state downloaded from the server, so it can be reviewed before applying it
+"""
+import json
+import threading
+from collections import Counter
+import click
+from redpush.index import RedpushIndex, check_duplicate_ids
+from redpush.layout import DashboardLayout
+from redpush.redash import queries_to_archive, check_deletions, is_unchanged, query_payload, visualization_payload, POSITION_FIELDS, content_hash, response_json
+
+PLAN_VERSION = 1
+
+
+def make_plan(url, server_queries, dashboards, new_queries, archive=False, max_deletions=None, max_percentage=None):
+    """
+        Compute all the operations needed to push new_queries (from the file) into the server, which has
+        server_queries (full queries) and dashboards.
+        The plan has three phases: the dashboards to create, then one list of dependent operations per query
+        (the query, its visualizations and their widgets, in that order) and at last the queries to archive
+        (only if archive is True, and within max_deletions and max_percentage, as the archive command).
+        The ids of objects that don't exist yet are referenced by redpush_id (or dashboard name) and resolved
+        when the plan is applied
+    """
+    check_duplicate_ids(new_queries)
+    index = RedpushIndex(server_queries, dashboards)
+    layout = DashboardLayout(new_queries)
+    plan = {'version': PLAN_VERSION, 'server': url, 'dashboards': [], 'queries': [], 'archive': []}
+
+    for query in new_queries:
+        if 'redpush_id' not in query:
+            print('Query without tracking id, ignored')
+            continue
+        redpush_id = query['redpush_id']
+        old_query = index.find_query(redpush_id)
+        operations = []
+        if old_query == None:
+            operations.append({'op': 'create_query', 'query': redpush_id, 'name': query.get('name'),
+                               'payload': query_payload(query, redpush_id)})
+        elif not is_unchanged(query, old_query):
+            operations.append({'op': 'update_query', 'query': redpush_id, 'name': query.get('name'), 'id': old_query['id'],
+                               'payload': query_payload(query, redpush_id)})
+
+        for visualization in query.get('visualizations') or []:
+            if 'redpush_id' not in visualization:
+                print('Visualization without tracking id, ignored')
+                continue
+            operations.extend(plan_visualization(plan, index, layout, redpush_id, old_query, visualization))
+
+        if operations:
+            plan['queries'].append({'query': redpush_id, 'id': old_query['id'] if old_query else None, 'operations': operations})
+
+    if archive:
+        to_archive = queries_to_archive(server_queries, new_queries)
+        check_deletions(to_archive, server_queries, max_deletions, max_percentage)
+        for query in to_archive:
+            plan['archive'].append({'op': 'archive_query', 'id': query['id'], 'name': query.get('name')})
+    return plan
+
+
+def plan_visualization(plan, index, layout, query_redpush_id, old_query, visualization):
+    """
+        The operations for one visualization and its widgets
+    """
+    operations = []
+    redpush_id = visualization['redpush_id']
+    old_visualization = index.find_visualization(old_query, redpush_id)
+    if old_visualization == None:
+        operations.append({'op': 'create_visualization', 'query': query_redpush_id, 'visualization': redpush_id,
+                           'payload': visualization_payload(visualization, redpush_id, None)})
+    elif not is_unchanged(visualization, old_visualization):
+        operations.append({'op': 'update_visualization', 'query': query_redpush_id, 'visualization': redpush_id,
+                           'id': old_visualization['id'], 'payload': visualization_payload(visualization, redpush_id, None)})
+
+    for widget_properties in visualization.get('redpush_dashboards') or []:
+        name = widget_properties['name']
+        dash = index.find_dashboard(name)
+        if dash == None:
+            # create it once, and remember it so the next widgets don't create it again
+            plan['dashboards'].append({'op': 'create_dashboard', 'name': name})
+            dash = {'id': None, 'slug': None, 'name': name, 'widgets': []}
+            index.add_dashboard(dash)
+        position = layout.position(name, query_redpush_id, redpush_id, widget_properties)
+        widget = None
+        if old_visualization != None and dash['id'] != None:
+            widget = index.find_widget(dash, old_visualization['id'])
+        if widget == None:
+            operations.append({'op': 'create_widget', 'query': query_redpush_id, 'visualization': redpush_id,
+                               'visualization_id': old_visualization['id'] if old_visualization else None,
+                               'dashboard': name, 'dashboard_id': dash['id'], 'slug': dash['slug'], 'position': position})
+        elif content_hash(widget.get('options', {}).get('position', {}), POSITION_FIELDS) != content_hash(position, POSITION_FIELDS):
+            operations.append({'op': 'update_widget', 'dashboard': name, 'dashboard_id': dash['id'], 'slug': dash['slug'],
+                               'id': widget['id'], 'position': position})
+    return operations
+
+
+def plan_counts(plan):
+    """
+        How many operations of each type are in the plan
+    """
+    counts = Counter(operation['op'] for operation in plan['dashboards'] + plan['archive'])
+    for query in plan['queries']:
+        counts.update(operation['op'] for operation in query['operations'])
+    return counts
+
+
+def print_plan(plan):
+    counts = plan_counts(plan)
+    if not counts:
+        print('Nothing to do', flush=True)
+    for op in sorted(counts):
+        print('{}: {}'.format(op, counts[op]), flush=True)
+
+
+def save_plan(plan, filename):
+    with open(filename, 'w') as stream:
+        json.dump(plan, stream, indent=2, default=str)
+
+
+def read_plan(filename):
+    with open(filename, 'r') as stream:
+        plan = json.load(stream)
+    if plan.get('version') != PLAN_VERSION:
+        raise click.ClickException('Unknown plan version {}'.format(plan.get('version')))
+    return plan
+
+
+def operation_request(server, operation, chain, dashboard_ids):
+    """
+        The request (method, path and json payload) to do for an operation of a query chain.
+        chain has the ids we got from the previous operations of the same query
+    """
+    op = operation['op']
+    if op in ('create_query', 'update_query'):
+        extra_path = '/{}'.format(operation['id']) if op == 'update_query' else ''
+        # the same messages as push: updates by id, new queries by name
+        if op == 'update_query':
+            print('updating query ' + str(operation['id']), flush=True)
+        else:
+            # plans saved before the name was stored have it only in the payload
+            print('creating new query ' + str(operation.get('name', operation['payload'].get('name'))), flush=True)
+        return 'POST', '{}/api/queries{}'.format(server.url, extra_path), operation['payload']
+    if op in ('create_visualization', 'update_visualization'):
+        extra_path = '/{}'.format(operation['id']) if op == 'update_visualization' else ''
+        payload = dict(operation['payload'], query_id=chain['query_id'])
+        return 'POST', '{}/api/visualizations{}'.format(server.url, extra_path), payload
+    if op == 'create_widget':
+        return 'POST', '{}/api/widgets'.format(server.url), {
+            'dashboard_id': operation['dashboard_id'] or dashboard_ids[operation['dashboard']],
+            'visualization_id': chain['visualization_ids'].get(operation['visualization'], operation['visualization_id']),
+            'options': {'position': operation['position']},
+            'width': 1
+        }
+    if op == 'update_widget':
+        return 'POST', '{}/api/widgets/{}'.format(server.url, operation['id']), {
+            'dashboard_id': operation['dashboard_id'],
+            'options': {'position': operation['position']},
+            'text': '',
+            'width': 1
+        }
+    raise click.ClickException('Unknown operation {}'.format(op))
+
+
+def operation_done(server, operation, response, chain):
+    """
+        Keep the ids from the response of an operation for the next ones of the chain
+    """
+    op = operation['op']
+    if op in ('create_query', 'update_query'):
+        chain['query_id'] = response['id']
+    elif op in ('create_visualization', 'update_visualization'):
+        chain['visualization_ids'][operation['visualization']] = response['id']
+        server.forget_cached('queries', chain['query_id'])  # the query version doesn't change with its visuals
+    elif op in ('create_widget', 'update_widget'):
+        server.forget_cached('dashboards', operation['slug'])
+
+
+def new_chain(query_plan):
+    return {'query_id': query_plan['id'], 'visualization_ids': {}}
+
+
+def existing_objects(server, plan):
+    """
+        The objects that the create operations of the plan would make and are already in the server, because
+        the plan (or part of it) was applied before: applying it again, or after it failed halfway, must not
+        create them twice. Only the listings are read, and the details of the queries and dashboards that
+        could have them.
+        Returns an index with those objects, and the ids of the queries that are not archived
+    """
+    index = RedpushIndex()
+    live_ids = set()
+    counts = plan_counts(plan)
+    if counts['create_query'] or counts['create_visualization'] or counts['archive_query']:
+        listing = list(server.Iter_Queries())
+        live_ids = set(query['id'] for query in listing)
+        by_redpush_id = {query['redpush_id']: query for query in listing if 'redpush_id' in query}
+        # the visualizations are only in the details of each query
+        to_detail = [by_redpush_id[query_plan['query']] for query_plan in plan['queries'] if query_plan['query'] in by_redpush_id and
+                     any(operation['op'] == 'create_visualization' for operation in query_plan['operations'])]
+        detailed = {query['id']: query for query in server.Iter_Full_Queries(to_detail)}
+        for query in listing:
+            index.add_query(detailed.get(query['id'], query))
+
+    names = set(operation['name'] for operation in plan['dashboards'])
+    names.update(operation['dashboard'] for query_plan in plan['queries'] for operation in query_plan['operations']
+                 if operation['op'] == 'create_widget')
+    if names:
+        path = '{}/api/dashboards'.format(server.url)
+        to_detail = [dash_id for dash_id in server.get_json(path) if dash_id['name'] in names]
+        for dashboard in server.map_concurrent(lambda dash_id: server.filter_dashboard(server.get_json('{}/{}'.format(path, dash_id['slug']))), to_detail):
+            index.add_dashboard(dashboard)
+    return index, live_ids
+
+
+def already_done(existing, operation, chain):
+    """
+        If the object a create operation would make is already in the server (check existing_objects),
+        keep its id for the next operations of the chain and return True
+    """
+    op = operation['op']
+    if op == 'create_query':
+        query = existing.find_query(operation['query'])
+        if query is not None:
+            print('query {} is already in the server with id {}'.format(operation.get('name', operation['query']), query['id']), flush=True)
+            chain['query_id'] = query['id']
+            return True
+    elif op == 'create_visualization':
+        visualization = existing.find_visualization(existing.find_query(operation['query']), operation['visualization'])
+        if visualization is not None:
+            chain['visualization_ids'][operation['visualization']] = visualization['id']
+            return True
+    elif op == 'create_widget':
+        dashboard = existing.find_dashboard(operation['dashboard'])
+        visualization_id = chain['visualization_ids'].get(operation['visualization'], operation['visualization_id'])
+        if dashboard is not None and visualization_id is not None and existing.find_widget(dashboard, visualization_id) is not None:
+            return True
+    return False
+
+
+def apply_plan(server, plan, fresh=False):
+    """
+        Execute the operations of the plan in the server.
+        Dashboards are created first, then the operations of each query are done in order (the visualizations
+        need the query id, the widgets the visualization id) but different queries go in parallel.
+        At last the queries to archive are deleted, in parallel too.
+        What is already in the server (the plan was applied before) is skipped, so a plan can be applied again.
+        Pass fresh if the plan was just made from the server state, then there is nothing to check.
+        Returns the counter of operations done
+    """
+    done = Counter()
+    lock = threading.Lock()
+
+    def count(op):
+        with lock:
+            done[op] += 1
+
+    existing, live_ids = (RedpushIndex(), None) if fresh else existing_objects(server, plan)
+    dashboard_ids = {}
+
+    def create_dashboard(operation):
+        dash = existing.find_dashboard(operation['name'])
+        if dash is not None:
+            print('dashboard {} is already in the server'.format(operation['name']), flush=True)
+            count('skipped')
+            return operation['name'], dash['id']
+        print('Creating dashboard: ', operation['name'], flush=True)
+        dash = server.Create_Dashboard(operation['name'])
+        count('create_dashboard')
+        return operation['name'], dash['id']
+
+    dashboard_ids.update(server.map_concurrent(create_dashboard, plan['dashboards']))
+
+    def apply_query(query_plan):
+        chain = new_chain(query_plan)
+        for operation in query_plan['operations']:
+            if already_done(existing, operation, chain):
+                count('skipped')
+                continue
+            method, path, payload = operation_request(server, operation, chain, dashboard_ids)
+            response = response_json(server.request(method, path, json=payload))
+            operation_done(server, operation, response, chain)
+            count(operation['op'])
+
+    server.map_concurrent(apply_query, plan['queries'])
+
+    def archive_query(operation):
+        if live_ids is not None and operation['id'] not in live_ids:
+            print('query {} is already archived'.format(operation['id']), flush=True)
+            count('skipped')
+            return
+        print('deleting query ' + str(operation['id']), flush=True)
+        server.delete_json('{}/api/queries/{}'.format(server.url, operation['id']))
+        count('archive_query')
+
+    server.map_concurrent(archive_query, plan['archive'])
+
+    if server.cache is not None:
+        server.cache.save()
+    return done
@@ -1,9 +1,227 @@
 """
     Class to interface with a redash server
 """
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import Counter
+from itertools import chain
 import click
 import requests
+from requests.adapters import HTTPAdapter
 from ruamel import yaml
+from redpush import pipeline
+from redpush.cache import cache_stamp
+from redpush.index import RedpushIndex, check_duplicate_ids
+from redpush.layout import DashboardLayout, WidgetPlacement
+from redpush.stats import recorder
+
+# status codes for which the server is asking us to slow down or is temporarily broken
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# the biggest page of queries redash gives
+QUERIES_PAGE_SIZE = 250
+# the page of users we ask for
+USERS_PAGE_SIZE = 250
+# methods that are safe to send again when the server failed in the middle
+IDEMPOTENT_METHODS = ('GET', 'DELETE')
+# properties of the yaml objects that are ours or the server's ids, so they don't count as content
+NOT_CONTENT_FIELDS = ('id', 'query_id', 'redpush_id', 'redpush_dashboards', 'visualizations')
+# the properties of the widget position that we manage
+POSITION_FIELDS = ('autoHeight', 'row', 'col', 'sizeX', 'sizeY')
+# the fields of the queries we keep (the ones that can be sent back), in this order
+QUERY_FIELDS = ('name', 'description', 'query', 'id', 'data_source_id', 'options', 'visualizations')
+# the fields of the visualizations, dashboards and widgets from the server that we don't need
+VISUALIZATION_DROP = ('created_at', 'updated_at')
+DASHBOARD_DROP = ('updated_at', 'created_at', 'is_archived', 'is_draft', 'version', 'layout', 'can_edit', 'user_id')
+WIDGET_DROP = ('updated_at', 'created_at', 'is_archived', 'is_draft', 'version')
+
+
+def content_hash(item, keys):
+    """
+        Canonical hash of the given keys of the item (missing ones count as None).
+        Used to know if an object in the file is different from the one in the server
+    """
+    content = {key: item.get(key) for key in keys}
+    canonical = json.dumps(content, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha1(canonical.encode('utf-8')).hexdigest()
+
+
+def content_keys(item):
+    """
+        The keys of an object from the file that we send to the server
+    """
+    return [key for key in item if key not in NOT_CONTENT_FIELDS]
+
+
+def item_hash(item):
+    """
+        Hash of the content of an object from the file, as recorded in the journal
+    """
+    return content_hash(item, content_keys(item))
+
+
+def is_unchanged(new_item, old_item):
+    """
+        Compare an object from the file against the one in the server.
+        Only the properties present in the file are compared, as they are the only ones that we send
+    """
+    if old_item is None:
+        return False
+    keys = content_keys(new_item)
+    return content_hash(new_item, keys) == content_hash(old_item, keys)
+
+
+def query_payload(query, redpush_id):
+    """
+        The query from the file as we send it to redash: without the visualizations, which are sent
+        one by one, and with our redpush_id hidden in the options
+    """
+    payload = {key: value for key, value in query.items() if key not in ('redpush_id', 'visualizations')}
+    payload['options'] = dict(payload.get('options') or {})
+    payload['options']['redpush_id'] = redpush_id
+    payload['is_draft'] = False
+    payload['is_archived'] = False
+    return payload
+
+
+def visualization_payload(visualization, redpush_id, query_id):
+    """
+        The visualization from the file as we send it to redash, without our properties
+        (the redpush_id is hidden in the options)
+    """
+    payload = {key: value for key, value in visualization.items() if key not in ('redpush_id', 'redpush_dashboards')}
+    payload['options'] = dict(payload.get('options') or {})
+    payload['options']['redpush_id'] = redpush_id
+    payload['query_id'] = query_id
+    return payload
+
+
+def query_redpush_id(query):
+    """
+        The redpush_id of a query from the server, either filtered (at the top) or not (in the options)
+    """
+    if 'redpush_id' in query:
+        return query['redpush_id']
+    return (query.get('options') or {}).get('redpush_id')
+
+
+def queries_to_archive(server_queries, new_queries):
+    """
+        The server queries that are not in the file (or that don't have a redpush_id)
+    """
+    new_ids = set(query['redpush_id'] for query in new_queries if 'redpush_id' in query)
+    return [query for query in server_queries if query_redpush_id(query) not in new_ids]
+
+
+def check_deletions(to_archive, server_queries, max_deletions=None, max_percentage=None):
+    """
+        As a safety net, stop if more than max_deletions queries (or max_percentage % of the server queries)
+        would be archived, as that usually means the wrong file or server
+    """
+    if max_deletions is not None and len(to_archive) > max_deletions:
+        raise click.ClickException('Refusing to archive {} queries, the maximum is {}'.format(len(to_archive), max_deletions))
+    if max_percentage is not None and server_queries and 100.0 * len(to_archive) / len(server_queries) > max_percentage:
+        raise click.ClickException('Refusing to archive {} of {} queries, more than {}%'.format(
+            len(to_archive), len(server_queries), max_percentage))
+
+
+def response_json(response):
+    """
+        The decoded json of a response from the server. If the server failed (after the retries) we stop there:
+        an error body taken as data would look like a missing object, and it would be created again
+    """
+    if not response.ok:
+        try:
+            body = response.json()
+            message = body.get('message', response.text) if isinstance(body, dict) else response.text
+        except ValueError:
+            message = response.text
+        raise click.ClickException('{} {} failed with {}: {}'.format(
+            response.request.method, response.url, response.status_code, message[:200]))
+    return response.json()
+
+
+def print_summary(summary):
+    """
+        Print how many objects of each kind were created/updated/left alone
+    """
+    for kind in ['queries', 'visualizations', 'widgets']:
+        counts = summary[kind]
+        print('{}: {} created, {} updated, {} unchanged'.format(kind, counts['created'], counts['updated'], counts['unchanged']), flush=True)
+
+
+def new_users(users, known_emails, report):
+    """
+        The users (dicts with `name` and `email`) whose email is not in known_emails, which is updated so the
+        repeated ones are skipped too. The skipped ones are counted in the report
+    """
+    for user in users:
+        email = user['email'].lower()
+        if email in known_emails:
+            report['skipped'] += 1
+            continue
+        known_emails.add(email)
+        yield user
+
+
+def user_created(user, response):
+    """
+        'created' or 'failed' (printing why) from the response of creating a user
+    """
+    if response.status_code >= 400:
+        try:
+            message = response.json().get('message', response.text)
+        except ValueError:
+            message = response.text
+        print('failed to create user {}: {}'.format(user['email'], message), flush=True)
+        return 'failed'
+    return 'created'
+
+
+def print_users_report(report):
+    print('users: {} created, {} skipped, {} failed'.format(report['created'], report['skipped'], report['failed']), flush=True)
+
+
+def split_redpush_id(item, options):
+    """
+        Move our redpush_id from the options to the item. The options are only copied if they have it
+    """
+    if isinstance(options, dict) and 'redpush_id' in options:
+        item['redpush_id'] = options['redpush_id']
+        options = {key: value for key, value in options.items() if key != 'redpush_id'}
+    return options
+
+
+def filter_visualization(visualization):
+    """
+        The visualization without the fields we don't need, and with its redpush_id at the end
+    """
+    new_visualization = {key: value for key, value in visualization.items() if key not in VISUALIZATION_DROP}
+    if 'options' in new_visualization:
+        options = new_visualization['options']
+        redpush_id = {}
+        new_visualization['options'] = split_redpush_id(redpush_id, options)
+        new_visualization.update(redpush_id)
+    return new_visualization
+
+
+def remaining_pages(first):
+    """
+        The numbers of the pages after the first one of a paginated listing, from what the first page says
+        (the server might give us smaller pages than we asked for)
+    """
+    pages = -(-first['count'] // first['page_size']) if first['page_size'] else 1
+    return range(2, pages + 1)
+
+
+def widget_position(widget_properties):
+    """
+        From the properties of a visualization in the yaml, we generate the position properties
+        that redash expects on the API
+    """
+    return WidgetPlacement.from_yaml(widget_properties).position()
 
 
 class Redash:
@@ -11,9 +229,111 @@ class Redash:
         Class to upload/download queries from redash 
     """
 
-    def __init__(self, url, api_key):
+    def __init__(self, url, api_key, concurrency=1, max_retries=5, backoff=0.5, pool_size=None, timeout=60, session=None, cache=None,
+                 buffer_size=None, journal=None):
         self.url = url
+        self.cache = cache  # optional StateCache, to avoid downloading again what didn't change
+        self.journal = journal  # optional Journal, to record what is pushed and resume a failed push
         self.api_key = api_key
+        self.concurrency = max(1, concurrency)
+        # the limit of requests in flight, whatever number of threads (listing, details, pushes...) are doing them
+        self.slots = threading.BoundedSemaphore(self.concurrency)
+        # how many items each stage of the streaming pipelines can have ready before they are consumed
+        self.buffer_size = buffer_size or 2 * self.concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        # all the traffic goes through this session, so connections are kept alive and reused.
+        # A different one (e.g. pointing to a fake server) can be passed for testing
+        if session is None:
+            session = self.create_session(pool_size or max(10, self.concurrency))
+        self.session = session
+        self.session.headers.update({'Authorization': 'Key {}'.format(self.api_key)})
+
+    def create_session(self, pool_size):
+        """
+            Create the http session with a connection pool big enough for our concurrency
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def request(self, method, path, **kwargs):
+        """
+            Send a request through the session and return the response.
+            If the server answers with 429 or 5xx (or the connection fails) we wait and try again, up to
+            max_retries times. The wait is an exponential backoff with jitter, or what the server tells us in
+            `Retry-After`. Non idempotent requests are only retried on 429, as on 5xx the change may have been done
+            No more than `concurrency` requests are sent at the same time (the waits between retries don't count)
+        """
+        kwargs.setdefault('timeout', self.timeout)
+        retry_status = RETRY_STATUS_CODES if method in IDEMPOTENT_METHODS else (429,)
+        attempt = 0
+        while True:
+            try:
+                with self.slots:
+                    start = time.perf_counter()  # the time waiting for a slot is not the server's
+                    response = self.session.request(method, path, **kwargs)
+            except requests.exceptions.ConnectionError as error:
+                if method not in IDEMPOTENT_METHODS or attempt >= self.max_retries:
+                    recorder.request(method, path, time.perf_counter() - start, error=error)
+                    raise
+                recorder.request(method, path, time.perf_counter() - start, error=error, retry=True)
+                response = None
+            else:
+                done = response.status_code not in retry_status or attempt >= self.max_retries
+                recorder.request(method, path, time.perf_counter() - start, response, retry=not done)
+                if done:
+                    return response
+            delay = self.backoff * (2 ** attempt) * random.uniform(0.5, 1.5)
+            if response is not None:
+                retry_after = response.headers.get('Retry-After')
+                if retry_after and retry_after.isdigit():
+                    delay = max(delay, int(retry_after))
+            status = response.status_code if response is not None else 'connection error'
+            print('server returned {} for {} {}, retrying in {:.1f}s'.format(status, method, path, delay), flush=True)
+            time.sleep(delay)
+            attempt += 1
+
+    def get_json(self, path, params=None):
+        """
+            GET the path and return the decoded json. Errors are raised
+        """
+        return response_json(self.request('GET', path, params=params))
+
+    def post_json(self, path, payload):
+        """
+            POST the payload as json and return the decoded response. Errors are raised
+        """
+        return response_json(self.request('POST', path, json=payload))
+
+    def delete_json(self, path, payload=None):
+        """
+            DELETE the path and return the decoded response. Errors are raised
+        """
+        return response_json(self.request('DELETE', path, json=payload))
+
+    def map_concurrent(self, function, items):
+        """
+            Apply function to every item using up to `concurrency` threads.
+            The results are returned in the same order as the items, so the output stays deterministic
+        """
+        return list(self.iter_concurrent(function, items))
+
+    def iter_concurrent(self, function, items):
+        """
+            Like map_concurrent, but yielding each result (in order) as soon as it is ready.
+            It is a stage of a streaming pipeline (check redpush.pipeline): the items are read and processed
+            in other threads while we consume the results, but only `buffer_size` of them ahead of us,
+            so if the consumer is slow we don't pile up results in memory
+        """
+        if self.concurrency <= 1:
+            for item in items:
+                yield function(item)
+            return
+        yield from pipeline.stage(function, items, workers=self.concurrency, buffer=self.buffer_size)
 
     def Get_Queries(self, dontfilter=False):
         """
@@ -22,54 +342,123 @@ class Redash:
             In case that you don't want to get extra contents from the queries to be filtered
             you can pass the dontfilter param.
         """
-        queries = []
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
+        return list(self.Iter_Queries(dontfilter))
+
+    def Iter_Queries(self, dontfilter=False):
+        """
+            Like Get_Queries, but yielding the queries as the pages arrive.
+            It asks for the biggest pages redash allows, and once the first page tells how many queries
+            there are, the rest of the pages are requested in parallel (they are still yielded in order)
+        """
         path = "{}/api/queries".format(self.url)
-        has_more = True
-        page = 1
-        while has_more:
-            response = requests.get(path, headers=headers, params={'page': page}).json()
-            queries.extend(response['results'])
-            has_more = page * response['page_size'] + 1 <= response['count']
-            page += 1
-
-        if not dontfilter:
-            queries = self.filter_fields_query_list(queries)
-        return queries
+
+        def get_page(page):
+            return self.get_json(path, params={'page': page, 'page_size': QUERIES_PAGE_SIZE})
+
+        first = get_page(1)
+        ids = []
+        for response in chain([first], self.iter_concurrent(get_page, remaining_pages(first))):
+            for query in response['results']:
+                ids.append(query['id'])
+                yield query if dontfilter else self.filter_fields_query(query)
+
+        if self.cache is not None:
+            # forget the queries that are not in the server anymore
+            self.cache.prune('queries', ids)
 
     def Get_Full_Queries(self, queries):
         """
-            Download the query and its visualizations.
+            Download the query and its visualizations. Check Iter_Full_Queries
+        """
+        return list(self.Iter_Full_Queries(queries))
+
+    def Iter_Full_Queries(self, queries):
+        """
+            Download the query and its visualizations, yielding them one by one as they arrive.
             If you download the queries in bulk, they don't contain the visualizations
             This call needs to first Get_Queries and then do one request per query to the
             server to get the visualizations
+            If there is a cache and the queries have their `version` (Get_Queries with dontfilter),
+            only the queries that changed since the last run are downloaded
         """
 
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
-        path = "{}/api/queries".format(self.url)
-        full_queries = []
-        for query in queries:
-            response = requests.get(path + '/' + str(query['id']), headers=headers).json()
-            full_query = self.filter_fields_query(response)
-            full_queries.append(full_query)
-        return full_queries
+        # listing -> details (one request per query, so we do them in parallel) -> filter -> whoever consumes us
+        # every stage runs at the same time, with bounded buffers between them
+        downloaded = self.iter_concurrent(self.download_query_detail, queries)
+        for full_query in pipeline.stage(self.filter_query_detail, downloaded, workers=1, buffer=self.buffer_size):
+            yield full_query
+        if self.cache is not None:
+            self.cache.save()
+
+    def download_query_detail(self, query):
+        """
+            The details of a query of the listing, from the cache if its stamp is the same as the last time.
+            Returns what filter_query_detail needs
+        """
+        stamp = cache_stamp(query)
+        if self.cache is not None:
+            cached = self.cache.get('queries', query['id'], stamp)
+            if cached is not None:
+                return query, stamp, cached, True
+        return query, stamp, self.get_json('{}/api/queries/{}'.format(self.url, query['id'])), False
+
+    def filter_query_detail(self, downloaded):
+        """
+            Filter the details downloaded by download_query_detail, and keep them in the cache
+        """
+        query, stamp, full_query, from_cache = downloaded
+        if from_cache:
+            return full_query
+        full_query = self.filter_fields_query(full_query)
+        if self.cache is not None:
+            self.cache.put('queries', query['id'], stamp, full_query)
+        return full_query
+
+    def fetch_query_detail(self, query):
+        """
+            The filtered details of a query of the listing, using the cache.
+            Iter_Full_Queries does the same, in two stages of its pipeline
+        """
+        return self.filter_query_detail(self.download_query_detail(query))
 
-    def Put_Queries(self, old_queries, new_queries):
+    def Iter_Server_State(self):
+        """
+            All the queries of the server with their visualizations, yielded as they arrive (the details are
+            downloaded while the list is still coming).
+            The listing isn't filtered, so it keeps the `version` of each query: with it the cache can tell which
+            details changed since the last run
+        """
+        return self.Iter_Full_Queries(self.Iter_Queries(dontfilter=True))
+
+    def Put_Queries(self, old_queries, new_queries, index=None, layout=None):
         """
             Upload the queries to the given redash server
             If it has visualizations it will put them also
             It uses the field (hack) `redpush_id` to find the query in redash server
             and update it if there. If the query being uploaded doesn't have that property
             it will not be uploaded.
+            Queries, visualizations and widgets that are the same in the server and in the file
+            are not sent again (so their version isn't bumped).
             The new queries list is modified on the process. So don't rely on it afterwards
+            An index (and layout) kept from a previous call can be given instead of the old queries, so the server
+            isn't read again; it is updated with what is sent, so it keeps matching the server
+            It returns the summary of how many objects were created/updated/unchanged
         """
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/queries".format(self.url)
+        # changed_queries are the queries created or updated (or with new widgets), the ones that need to be run
+        summary = {'queries': Counter(), 'visualizations': Counter(), 'widgets': Counter(), 'changed_queries': []}
+
+        check_duplicate_ids(new_queries)
 
         # we get dashboards before, as an optimization. Before we were doing it on each widget, but it is
         # very expensive, so we move it out, and pass it to the chain down. We save lots of extra calls to
         # the server making it so much faster to run
-        dash_list = self.Get_Dashboards()
+        # Everything goes to an index so we don't need to scan the lists for each object
+        if index is None:
+            index = RedpushIndex(old_queries, self.Get_Dashboards())
+        # all the widgets of each dashboard are placed at once, before the queries lose their visualizations
+        if layout is None:
+            layout = DashboardLayout(new_queries)
 
         for query in new_queries:
             if 'redpush_id' not in query:
@@ -79,76 +468,93 @@ class Redash:
             redpush_id = query['redpush_id']
             query.pop('redpush_id', None)
 
-            old_query = self.find_by_redpush_id(old_queries, redpush_id)
+            old_query = index.find_query(redpush_id)
             # print(old_query)
-            extra_path = ''
-            if old_query != None:
-                # we are updating the query
+            visualizations = query.pop('visualizations', None)  # visualizations need to be uploaded in a diff call
+
+            done = self.journal_find('query', [redpush_id])
+            if old_query == None and done != None:
+                # created by the push we are resuming, but the server listing doesn't show it (its redpush_id
+                # didn't get there), so it is updated with the id we got then instead of created again
+                old_query = {'id': done['id'], 'redpush_id': redpush_id, 'visualizations': []}
+                index.add_query(old_query)
+            changed = not is_unchanged(query, old_query)
+            if not changed:
                 id = old_query['id']
-                print('updating query ' + str(id), flush=True)
-                extra_path = '/' + str(id)
+                summary['queries']['unchanged'] += 1
             else:
-                print('creating new query ' + query['name'], flush=True)
-
-            if 'options' not in query:
-                query['options'] = {}
-            query['options']['redpush_id'] = redpush_id
-            query['is_draft'] = False
-            query['is_archived'] = False
-            if 'visualizations' in query:
-                visualizations = query['visualizations']
-                # visualizations need to be uploaded in a diff call
-                query['visualizations'] = None
-
-            response = requests.post(path + extra_path, headers=headers, json=query).json()
-            id = response['id']
+                extra_path = ''
+                if old_query != None:
+                    # we are updating the query
+                    id = old_query['id']
+                    print('updating query ' + str(id), flush=True)
+                    extra_path = '/' + str(id)
+                    summary['queries']['updated'] += 1
+                else:
+                    print('creating new query ' + query['name'], flush=True)
+                    summary['queries']['created'] += 1
+
+                response = self.post_json(path + extra_path, query_payload(query, redpush_id))
+                id = response['id']
+                self.journal_record('query', [redpush_id], id)
+                if old_query == None:
+                    old_query = {'id': id, 'redpush_id': redpush_id, 'visualizations': []}
+                    index.add_query(old_query)
+                # so the index has what is in the server now
+                old_query.update((key, query[key]) for key in content_keys(query))
             # Now we handle the visualization
+            widgets_created = summary['widgets']['created']
             if visualizations != None:
                 for visualization in visualizations:
                     visualization['query_id'] = id
 
-                    # we might have received a new copy of the dashboards from the server
-                    dash_list = self.Put_Visualization(visualization, old_query, dash_list)
+                    self.Put_Visualization(visualization, old_query, index, summary, layout)
             # print(response)
+            if changed or summary['widgets']['created'] > widgets_created:
+                summary['changed_queries'].append(dict(query_payload(query, redpush_id), id=id))
 
-    def Archive_Missing_Queries(self, server_queries, new_queries):
+        if self.cache is not None:
+            self.cache.save()
+        print_summary(summary)
+        return summary
+
+    def Archive_Missing_Queries(self, server_queries, new_queries, max_deletions=None, max_percentage=None, dry_run=False):
         """
             Make a diff between server_queries and the new_queries,
             the ones appearing in server_queries but not in new_queries
-            are archived.
+            are archived (also the ones without redpush_id).
+            As a safety net, if more than max_deletions queries (or max_percentage % of the server queries)
+            would be archived nothing is done (check check_deletions).
+            With dry_run the queries are only listed.
+            The deletes are done in parallel. Returns the counter of archived and failed queries
         """
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/queries".format(self.url)
-
-        for query in server_queries:
-
-            deleteQuery = False
-            if 'options' in query:
-                if 'redpush_id' in query['options']:
-                    redpush_id = query['options']['redpush_id']
-                    new_query = self.find_by_redpush_id(new_queries, redpush_id)
-                    deleteQuery = new_query == None
-
-                else:
-                    deleteQuery = True
-                    print('Query without tracking id, deleting…', flush=True)
-                    # if query doesn't have redpush_id we will get rid of it
-
-            else:
-                    deleteQuery = True
-                    print('Query without tracking id, deleting…', flush=True)
-                    # if query doesn't have redpush_id we will get rid of it
-
-            if deleteQuery:
-                # the server query isn't in the file, so we archive it
-                id = query['id']
-                print('deleting query ' + str(id), flush=True)
-                extra_path = '/' + str(id)
-                response = requests.delete(path + extra_path, headers=headers, json=query).json()
-                # if response.status_code != 200:
-                # print('error deleting query', response)
-
-    def Put_Visualization(self, visualization, old_query, dash_list):
+        server_queries = list(server_queries)
+        to_archive = queries_to_archive(server_queries, new_queries)
+        untracked = sum(1 for query in to_archive if query_redpush_id(query) is None)
+        print('{} of {} queries to archive ({} without tracking id)'.format(len(to_archive), len(server_queries), untracked), flush=True)
+        check_deletions(to_archive, server_queries, max_deletions, max_percentage)
+
+        done = Counter()
+        if dry_run:
+            for query in to_archive:
+                print('would archive query {} ({})'.format(query['id'], query.get('name')), flush=True)
+            return done
+
+        def archive_query(query):
+            print('deleting query ' + str(query['id']), flush=True)
+            # the query is archived by its id, no need to send its body
+            response = self.request('DELETE', '{}/{}'.format(path, query['id']))
+            if not response.ok:
+                print('error deleting query {}: {} {}'.format(query['id'], response.status_code, response.text[:200]), flush=True)
+            return response.ok
+
+        for archived in self.iter_concurrent(archive_query, to_archive):
+            done['archived' if archived else 'failed'] += 1
+        print('archived: {}, failed: {}'.format(done['archived'], done['failed']), flush=True)
+        return done
+
+    def Put_Visualization(self, visualization, old_query, index, summary=None, layout=None):
         """
             Upload the visualizations to the given redash server
             If it has visualizations it will put them also
@@ -160,15 +566,17 @@ class Redash:
             It needs also the old query if already there, so we update the visuals and
             not create duplicates
 
-            It returns the dash_list, which might or might not be the same we received. If nothing was 
-            added then it is the same, otherwise it was refreshed from the server and we have new contents
+            The index (RedpushIndex) is used to find the visuals, dashboards and widgets in the server,
+            and it is updated with the objects created here
+            If a summary is given, the created/updated/unchanged counters are updated there
         """
+        if summary is None:
+            summary = {'visualizations': Counter(), 'widgets': Counter()}
 
         if 'redpush_id' not in visualization:
             print('Visualization without tracking id, ignored')
             return
 
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/visualizations".format(self.url)
 
         # redash doesn't allow our extra properties, so remove them
@@ -182,71 +590,96 @@ class Redash:
 
         extra_path = ''
 
-        if old_query != None:
-            # we are updating so we need to find the id first
-            filtered = list(filter(lambda x: 'redpush_id' in x and x['redpush_id'] == redpush_id, old_query['visualizations']))
-            if filtered:
-                if len(filtered) > 1:
-                    print('There are repeated visuals. Using the first')
-                old_id = filtered[0]['id']
-                extra_path = '/{}'.format(old_id)
-
-        if 'options' not in visualization:
-            visualization['options'] = {}
-        visualization['options']['redpush_id'] = redpush_id
-        response = requests.post(path + extra_path, headers=headers, json=visualization).json()
-        visual_id = response['id']  # the id we got from the just added visual
+        # if we are updating we need to find the id first
+        old_visualization = index.find_visualization(old_query, redpush_id)
+        query_redpush_id = old_query['redpush_id'] if old_query != None else None
+        done = self.journal_find('visualization', [query_redpush_id, redpush_id])
+        resumed = old_visualization == None and done != None and old_query != None
+        if resumed:
+            # created by the push we are resuming, but we didn't get it from the server
+            old_visualization = {'id': done['id'], 'redpush_id': redpush_id}
+            index.add_visualization(old_query, old_visualization)
+        if old_visualization != None:
+            extra_path = '/{}'.format(old_visualization['id'])
+
+        if is_unchanged(visualization, old_visualization) or (resumed and done['hash'] == item_hash(visualization)):
+            visual_id = old_visualization['id']
+            summary['visualizations']['unchanged'] += 1
+        else:
+            summary['visualizations']['updated' if old_visualization else 'created'] += 1
+            response = self.post_json(path + extra_path, visualization_payload(visualization, redpush_id, visualization['query_id']))
+            visual_id = response['id']  # the id we got from the just added visual
+            self.journal_record('visualization', [query_redpush_id, redpush_id], visual_id, hash=item_hash(visualization))
+            self.forget_cached('queries', visualization['query_id'])  # the query version doesn't change with its visuals
+            if old_visualization == None and old_query != None:
+                old_visualization = {'id': visual_id, 'redpush_id': redpush_id}
+                index.add_visualization(old_query, old_visualization)
+            if old_visualization != None:
+                # so the index has what is in the server now
+                old_visualization.update((key, visualization[key]) for key in content_keys(visualization))
 
         # if there is redpush_dashboard then lets check if we need to add to dashboard
         if redpush_dashboards:
             for widget_properties in redpush_dashboards:
                 # check if that dashboard is already in server, and if not create it
                 # check against name, as if deleted it would get a new slug
-                filtered_dash_list = list(filter(lambda x: x['name'] == widget_properties['name'], dash_list))
-                if filtered_dash_list:
-                    if len(filtered_dash_list) > 1:
-                        print('More than one dashboard with the same id, error!!!')
-                    dash = filtered_dash_list[0]
-                else:
+                dash = index.find_dashboard(widget_properties['name'])
+                done = self.journal_find('dashboard', [widget_properties['name']])
+                if dash == None and done != None:
+                    # created by the push we are resuming
+                    dash = {'id': done['id'], 'slug': done['slug'], 'name': widget_properties['name'], 'widgets': []}
+                    index.add_dashboard(dash)
+                if dash == None:
                     print('Creating dashboard: ', widget_properties['name'])
 
+                    # we add it to the index from the response, no need to get all the dashboards again
                     dash = self.Create_Dashboard(widget_properties['name'])
-                    dash_list = self.Get_Dashboards()
+                    dash['widgets'] = []
+                    index.add_dashboard(dash)
+                    self.journal_record('dashboard', [dash['name']], dash['id'], slug=dash.get('slug'))
 
                 # check if visual already in dashboard, and if not add it
-                need_to_add_widget = False
-                if 'widgets' in dash and dash['widgets']:
-                    #find the widget if already there
-                    filtered_widget_list = list(filter(lambda x: 'visualization' in x and x['visualization']['id'] == visual_id, dash['widgets']))
-                    if not filtered_widget_list:
-                        need_to_add_widget = True
-                else:
-                    need_to_add_widget = True
+                widget = index.find_widget(dash, visual_id)
+                widget_key = [dash['name'], query_redpush_id, redpush_id]
+                done = self.journal_find('widget', widget_key)
+                if widget == None and done != None and done['visualization_id'] == visual_id:
+                    # created by the push we are resuming
+                    widget = {'id': done['id'], 'visualization': {'id': visual_id}, 'options': {'position': done['position']}}
+                    dash.setdefault('widgets', []).append(widget)
+                    index.add_widget(dash, widget)
 
                 # as we have the visualization from file, we need to put the id
                 visualization['id'] = visual_id
-                row = 0
-                col = 0
-                if 'row' in widget_properties and widget_properties['row'] > 0:
-                    row = widget_properties['row']
-                if 'col' in widget_properties and widget_properties['col'] > 0:
-                    col = widget_properties['col']
-                if need_to_add_widget:
-                    self.Create_Widget(dash['id'], visualization, widget_properties)
+                position = None  # where the layout puts it, if we have one
+                if layout is not None and old_query is not None:
+                    position = layout.position(widget_properties['name'], old_query['redpush_id'], redpush_id, widget_properties)
+                in_position = widget != None and self.is_widget_in_position(widget, widget_properties, position)
+                if not in_position:
+                    self.forget_cached('dashboards', dash['slug'])
+                if widget == None:
+                    response = self.Create_Widget(dash['id'], visualization, widget_properties, position)
+                    widget = {'id': response['id'], 'visualization': {'id': visual_id},
+                              'options': {'position': position or self.get_Widget_position(widget_properties)}}
+                    dash.setdefault('widgets', []).append(widget)
+                    index.add_widget(dash, widget)
+                    summary['widgets']['created'] += 1
+                elif in_position:
+                    summary['widgets']['unchanged'] += 1
+                    continue
                 else:
-                    first = filtered_widget_list[0]
-                    self.Update_Widget(dash['id'], first['id'], widget_properties)
-
-        return dash_list  # In case we have refreshed it when adding a new one
+                    self.Update_Widget(dash['id'], widget['id'], widget_properties, position)
+                    widget.setdefault('options', {})['position'] = position or self.get_Widget_position(widget_properties)
+                    summary['widgets']['updated'] += 1
+                self.journal_record('widget', widget_key, widget['id'], visualization_id=visual_id,
+                                    position=widget['options']['position'])
 
-    def Create_Widget(self, dashboard_id, visual, widget_properties):
+    def Create_Widget(self, dashboard_id, visual, widget_properties, position=None):
         """
-            Create a widget into a dashboard
+            Create a widget into a dashboard, in the position given (by default, the one of its properties)
         """
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/widgets".format(self.url)
 
-        position = self.get_Widget_position(widget_properties)
+        position = position or self.get_Widget_position(widget_properties)
 
         widget = {
             'visualization': visual,
@@ -256,59 +689,30 @@ class Redash:
             'width': 1
         }
 
-        response = requests.post(path, headers=headers, json=widget).json()
+        return self.post_json(path, widget)
 
     def get_Widget_position(self, widget_properties):
         """
             From the properties of a visualization in the yaml, we generate the position properties
             that redash expects on the API
         """
-        size = "medium"
-        if 'size' in widget_properties and len(widget_properties['size']) > 0:
-            size = widget_properties['size']
-        col = 0
-        if 'col' in widget_properties and widget_properties['col'] > 0:
-            col = widget_properties['col']
-        row = 0
-        if 'row' in widget_properties and widget_properties['row'] > 0:
-            row = widget_properties['row']
-
-        multiplierDef = {
-            'small': 2,
-            'medium': 3,
-            'large': 1
-        }
+        return widget_position(widget_properties)
 
-        sizeXDef = {    # defining how big in X the widgets are
-            'small': 2,
-            'medium': 3,
-            'large': 6  # max size in redash
-        }
-
-        sizeYDef = {    # defining how big in X the widgets are
-            'small': 5,
-            'medium': 9,
-            'large': 12
-        }
-        multiplier = multiplierDef[size]
-
-        position = {
-            'autoHeight': False,
-            'row': row,
-            'col': col * multiplier,
-            'sizeX': sizeXDef[size],
-            'sizeY': sizeYDef[size],
-        }
-        return position
+    def is_widget_in_position(self, widget, widget_properties, position=None):
+        """
+            Check if the widget from the server is already placed where the yaml properties (or the layout) say
+        """
+        current = widget.get('options', {}).get('position', {})
+        position = position or self.get_Widget_position(widget_properties)
+        return content_hash(current, POSITION_FIELDS) == content_hash(position, POSITION_FIELDS)
 
-    def Update_Widget(self, dashboard_id, widget_id, widget_properties):
+    def Update_Widget(self, dashboard_id, widget_id, widget_properties, position=None):
         """
             Update a widget already in a dashboard
         """
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/widgets/{}".format(self.url, widget_id)
 
-        position = self.get_Widget_position(widget_properties)
+        position = position or self.get_Widget_position(widget_properties)
 
         widget = {
             'dashboard_id': dashboard_id,
@@ -316,7 +720,7 @@ class Redash:
             'text': '',
             'width': 1
         }
-        response = requests.post(path, headers=headers, json=widget).json()
+        response = self.post_json(path, widget)
 
     def Get_Dashboards(self):
         """
@@ -324,74 +728,98 @@ class Redash:
             For that it needs to first get the list and then get the details of each one
 
         """
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/dashboards".format(self.url)
-        dash_id_list = requests.get(path, headers=headers).json()
-
-        path_id_template = "{}/api/dashboards/{}"
-        dashboards = []
-        # now we get the details
-        for dash_id in dash_id_list:
-            slug = dash_id['slug']
-            path_id = path_id_template.format(self.url, slug)
-            dashboard = requests.get(path_id, headers=headers).json()
-
-            # we need to filter some stuff, mostly inside the widgets
-            dashboard = self.filter_fields_blacklist(dashboard, ['updated_at', 'created_at', 'is_archived', 'is_draft', 'version', 'layout', 'can_edit', 'user_id'])
-            if 'widgets' in dashboard:
-                filtered_widgets = []
-                for widget in dashboard['widgets']:
-                    filt_widget = self.filter_fields_blacklist(widget, ['updated_at', 'created_at', 'is_archived', 'is_draft', 'version'])
-                    filtered_widgets.append(filt_widget)
-                dashboard['widgets'] = filtered_widgets
-            dashboards.append(dashboard)
+        dash_id_list = self.get_json(path)
 
+        # now we get the details, one request per dashboard so we do them in parallel
+        dashboards = self.map_concurrent(self.fetch_dashboard_detail, dash_id_list)
+        if self.cache is not None:
+            self.cache.prune('dashboards', [dash_id['slug'] for dash_id in dash_id_list])
+            self.cache.save()
         return dashboards
 
+    def fetch_dashboard_detail(self, dash_id):
+        """
+            The filtered details of a dashboard of the listing, from the cache if its stamp is the same as the last time
+        """
+        slug = dash_id['slug']
+        stamp = cache_stamp(dash_id)
+        if self.cache is not None:
+            cached = self.cache.get('dashboards', slug, stamp)
+            if cached is not None:
+                return cached
+        dashboard = self.filter_dashboard(self.get_json('{}/api/dashboards/{}'.format(self.url, slug)))
+        if self.cache is not None:
+            self.cache.put('dashboards', slug, stamp, dashboard)
+        return dashboard
+
+    @recorder.timed_calls('filter')
+    def filter_dashboard(self, dashboard):
+        """
+            Remove the fields of the dashboard (and its widgets) that we don't need
+        """
+        new_dashboard = {key: value for key, value in dashboard.items() if key not in DASHBOARD_DROP}
+        if 'widgets' in new_dashboard:
+            new_dashboard['widgets'] = [{key: value for key, value in widget.items() if key not in WIDGET_DROP}
+                                        for widget in new_dashboard['widgets']]
+        return new_dashboard
+
+    def journal_find(self, op, key):
+        """
+            What the push we are resuming did with an object, if there is a journal
+        """
+        if self.journal is None:
+            return None
+        return self.journal.find(op, key)
+
+    def journal_record(self, op, key, id, **data):
+        if self.journal is not None:
+            self.journal.record(op, key, id, **data)
+
+    def forget_cached(self, kind, key):
+        """
+            Remove an object from the cache (if any) because we changed something the server stamp doesn't show
+        """
+        if self.cache is not None:
+            self.cache.invalidate(kind, key)
+
     def Create_Dashboard(self, name):
         """
             Create a dashboard using the name both for the name and slug (the part of the path at the end of the dashboard url)
             Warning, this function doesn't check if the dashboard with that name is already created, and if it is
             it will create a duplicate
         """
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/dashboards".format(self.url)
 
         dash = {'name': name}
-        response = requests.post(path, headers=headers, json=dash).json()
-        # as we want it published, we need a second request to update it
+        response = self.post_json(path, dash)
+        # as we want it published, we need a second request to update it (redash always creates drafts)
         response['is_draft'] = False
         update = self.filter_fields_blacklist(response, ['updated_at', 'created_at', 'version'])
 
-        response = requests.post(path + '/' + str(response['id']), headers=headers, json=update).json()
+        self.request('POST', path + '/' + str(response['id']), json=update)
         # This call returns an error but still makes the change :)
-        return update
+        # We return it as Get_Dashboards would, so it can be added to what we already have
+        return self.filter_dashboard(update)
 
+    @recorder.timed_calls('filter')
     def filter_fields_query(self, query):
         """
             Remove all unneeded fields of the query from redash.
             That means mostly the ones that cannot be sent when creating a new query
             it also does the hack of moving the redpush_id from the options to the top level of the query
+            Everything is copied once, in one pass
         """
         new_query = {}
-        for valid_key in ['name', 'description', 'query', 'id', 'data_source_id', 'options', 'visualizations']:
-            if valid_key in query:
-                if valid_key == 'visualizations':
-                    # if there is a visualizations key, we need to do some cleanup also
-                    new_query[valid_key] = list(map(lambda i: self.filter_fields_blacklist(i, ['created_at', 'updated_at']), query[valid_key]))
-                    for visualization in new_query['visualizations']:
-                        if 'options' in visualization and 'redpush_id' in visualization['options']:
-                            redpush_id = visualization['options']['redpush_id']
-                            del visualization['options']['redpush_id']
-                            visualization['redpush_id'] = redpush_id
-                elif valid_key == 'options':
-                    # check if we have the redpush_id and if we do put it in the query
-                    if 'redpush_id' in query['options']:
-                        new_query['redpush_id'] = query['options']['redpush_id']
-                    new_query[valid_key] = self.filter_fields_blacklist(query[valid_key], ['redpush_id'])  # we don't want our internal id there
-                else:
-                    new_query[valid_key] = query[valid_key]
-
+        for key in QUERY_FIELDS:
+            if key not in query:
+                continue
+            value = query[key]
+            if key == 'options':
+                value = split_redpush_id(new_query, value)  # the redpush_id goes before the options
+            elif key == 'visualizations':
+                value = [filter_visualization(visualization) for visualization in value]
+            new_query[key] = value
         return new_query
 
     def filter_fields_query_list(self, queries):
@@ -424,14 +852,38 @@ class Redash:
                 if query['redpush_id'] == redpush_id:
                     return query
 
+    def Get_Users(self):
+        """
+            Get all users from the given redash server. After the first page we know how many there are,
+            so the rest of pages are requested in parallel
+        """
+        path = "{}/api/users".format(self.url)
+        first = self.get_json(path, params={'page': 1, 'page_size': USERS_PAGE_SIZE})
+        if isinstance(first, list):
+            return first  # old redash versions return all of them without pages
+
+        def get_page(page):
+            return self.get_json(path, params={'page': page, 'page_size': first['page_size']})
+
+        users = list(first['results'])
+        for response in self.iter_concurrent(get_page, remaining_pages(first)):
+            users.extend(response['results'])
+        return users
+
     def Create_Users(self, users):
         """
-            Tries to create in Redash a list of users. users is a list of dicts with `name` and `email`
-            If the user is already created then it will silently fail
+            Create in Redash a list (or any iterable) of users. users are dicts with `name` and `email`
+            The users already in the server (or repeated in the list) are skipped, the rest are created
+            in parallel. It prints and returns a report of how many were created, skipped and failed
         """
-        headers = {'Authorization': 'Key {}'.format(self.api_key)}
         path = "{}/api/users".format(self.url)
+        known_emails = set(user['email'].lower() for user in self.Get_Users() if user.get('email'))
+
+        def create_user(user):
+            return user_created(user, self.request('POST', path, json=user))
 
-        for user in users:
-            response = requests.post(path, headers=headers, json=user).json()
-            print(response)
+        report = Counter()
+        for result in self.iter_concurrent(create_user, new_users(users, known_emails, report)):
+            report[result] += 1
+        print_users_report(report)
+        return report
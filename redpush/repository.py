@@ -0,0 +1,247 @@
+"""
+    Reading and writing the queries yaml (or json), either as one file or as a directory with one file per query
+"""
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+from ruamel import yaml
+from redpush.stats import recorder
+
+# the formats of the files, by their extension. yaml is the default
+FORMAT_EXTENSIONS = {'.yaml': 'yaml', '.yml': 'yaml', '.json': 'json', '.jsonl': 'jsonl'}
+# the formats we can write: yaml is the one to edit by hand, fast-yaml is the same yaml written by libyaml
+# (much faster, but empty values are written as `null`), json and jsonl (one query per line) are for machines
+FORMATS = ('yaml', 'fast-yaml', 'json', 'jsonl')
+# below this number of files to parse, starting the worker processes costs more than it saves
+MIN_FILES_FOR_PROCESSES = 16
+
+try:
+    # libyaml, if ruamel.yaml was installed with it
+    from ruamel.yaml import CSafeLoader as FastLoader, CSafeDumper as FastBaseDumper
+except ImportError:
+    from ruamel.yaml import SafeLoader as FastLoader, SafeDumper as FastBaseDumper
+
+
+class FastDumper(FastBaseDumper):
+    """
+        Dumper that writes yaml like the round trip one, keys in their order and multi-line strings
+        (the sql) as literal blocks, but with libyaml
+    """
+
+
+def represent_str(dumper, data):
+    return dumper.represent_scalar('tag:yaml.org,2002:str', str(data), style='|' if '\n' in data else None)
+
+def represent_dict(dumper, data):
+    return dumper.represent_mapping('tag:yaml.org,2002:map', list(data.items()))
+
+def represent_list(dumper, data):
+    return dumper.represent_sequence('tag:yaml.org,2002:seq', list(data))
+
+FastDumper.add_representer(str, represent_str)
+FastDumper.add_multi_representer(str, represent_str)
+FastDumper.add_representer(dict, represent_dict)
+FastDumper.add_multi_representer(dict, represent_dict)
+FastDumper.add_multi_representer(list, represent_list)
+
+
+def file_format(filename):
+    """
+        The format of a file, from its extension
+    """
+    return FORMAT_EXTENSIONS.get(os.path.splitext(filename)[1].lower(), 'yaml')
+
+def write_item(item, stream, output_format, first):
+    """
+        Write one item of a list, so a list can be saved as it is generated
+    """
+    if output_format == 'yaml':
+        yaml.scalarstring.walk_tree(item)
+        yaml.dump([item], stream, Dumper=yaml.RoundTripDumper)
+    elif output_format == 'fast-yaml':
+        yaml.dump([item], stream, Dumper=FastDumper, default_flow_style=False, allow_unicode=True)
+    elif output_format == 'json':
+        stream.write('[\n' if first else ',\n')
+        stream.write(json.dumps(item, indent=2, default=str, ensure_ascii=False))
+    else:
+        stream.write(json.dumps(item, default=str, ensure_ascii=False) + '\n')
+
+def write_end(stream, output_format, empty):
+    if output_format == 'json':
+        stream.write('[]\n' if empty else '\n]\n')
+    elif empty and output_format == 'yaml':
+        yaml.dump([], stream, Dumper=yaml.RoundTripDumper)
+    elif empty and output_format == 'fast-yaml':
+        yaml.dump([], stream, Dumper=FastDumper)
+
+def save_yaml(queries, filename, output_format=None):
+    """
+        Save the queries into yaml (or the format given, by default the one of the file extension)
+    """
+    save_yaml_stream(queries, filename, output_format)
+
+def save_yaml_stream(queries, filename, output_format=None):
+    """
+        Save the queries into yaml one by one, as they come from the iterator.
+        We don't need to have all of them in memory and each one is in the file as soon as we have it.
+        The result is the same as dumping the whole list, as the items of a list are just written one after the other.
+        The list is closed even if the iterator fails, so a json file keeps the queries saved until then
+    """
+    output_format = output_format or file_format(filename)
+    with open(filename, 'w', encoding='utf-8') as stream:
+        empty = True
+        try:
+            for query in queries:
+                with recorder.timed(output_format + ' dump'):
+                    write_item(query, stream, output_format, empty)
+                    stream.flush()
+                empty = False
+        finally:
+            # if the queries stop coming (e.g. the server failed), the ones saved must still be readable
+            write_end(stream, output_format, empty)
+
+def read_yaml(filename):
+    """
+        Load the queries from a file (yaml, json or json lines, by its extension).
+        We never write back what we read, so comments don't need to be kept and yaml is read with libyaml
+    """
+    input_format = file_format(filename)
+    with recorder.timed(input_format + ' load'), open(filename, 'r', encoding='utf-8') as stream:
+        if input_format == 'json':
+            return json.load(stream)
+        if input_format == 'jsonl':
+            return [json.loads(line) for line in stream if line.strip()]
+        return yaml.load(stream, Loader=FastLoader)
+
+def query_filename(query, extension='.yaml'):
+    """
+        The name of the file of a query in the directory layout. It uses the redpush_id, so the file
+        doesn't change if the query is renamed
+    """
+    if 'redpush_id' in query:
+        return 'query-{}{}'.format(query['redpush_id'], extension)
+    return 'server-{}{}'.format(query['id'], extension)
+
+def save_yaml_dir(queries, directory, output_format='yaml'):
+    """
+        Save each query in its own file in the directory, as they come from the iterator
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    extension = '.json' if output_format in ('json', 'jsonl') else '.yaml'
+    for query in queries:
+        with recorder.timed(output_format + ' dump'), open(os.path.join(directory, query_filename(query, extension)), 'w', encoding='utf-8') as stream:
+            if output_format == 'yaml':
+                yaml.scalarstring.walk_tree(query)
+                yaml.dump(query, stream, Dumper=yaml.RoundTripDumper)
+            elif output_format == 'fast-yaml':
+                yaml.dump(query, stream, Dumper=FastDumper, default_flow_style=False, allow_unicode=True)
+            else:
+                json.dump(query, stream, indent=2, default=str, ensure_ascii=False)
+                stream.write('\n')
+
+def find_yaml_files(directory):
+    """
+        All the yaml (or json) files under the directory, sorted so the queries are always loaded in the same order
+    """
+    files = []
+    for root, dirs, names in os.walk(directory):
+        dirs[:] = [name for name in dirs if not name.startswith('.')]
+        for name in names:
+            if name.endswith(tuple(FORMAT_EXTENSIONS)) and not name.startswith('.'):
+                files.append(os.path.join(root, name))
+    return sorted(files)
+
+def read_yaml_queries(filename):
+    """
+        Load the queries of one file of the directory layout. A file can have a list of queries or just one
+    """
+    contents = read_yaml(filename)
+    if contents is None:
+        return []
+    if isinstance(contents, list):
+        return contents
+    return [contents]
+
+def file_stamp(filename):
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_size)
+
+def parse_cache_path(cache_dir, directory):
+    key = hashlib.sha1(os.path.abspath(directory).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'parsed-{}.json'.format(key))
+
+def load_parse_cache(path):
+    """
+        The parsed files kept in the cache: filename -> (stamp, queries).
+        It is JSON, like the state cache: the cache directory can come from a shared CI cache, and loading
+        it must not run anything
+    """
+    if path is None or not os.path.exists(path):
+        return {}
+    try:
+        with open(path, 'r', encoding='utf-8') as stream:
+            entries = json.load(stream)
+        return {filename: (tuple(entry['stamp']), entry['queries']) for filename, entry in entries.items()}
+    except (ValueError, KeyError, TypeError, AttributeError):
+        print('Ignoring corrupted cache ' + path)
+        return {}
+
+def save_parse_cache(path, parsed):
+    """
+        Write the parsed files to the cache. Values json doesn't have (dates) are stored as strings,
+        as content_hash compares them
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    entries = {filename: {'stamp': list(stamp), 'queries': queries} for filename, (stamp, queries) in parsed.items()}
+    with open(path + '.tmp', 'w', encoding='utf-8') as stream:
+        json.dump(entries, stream, default=str, ensure_ascii=False)
+    os.replace(path + '.tmp', path)
+
+def read_yaml_dir(directory, cache_dir=None, workers=None):
+    """
+        Load the queries from all the yaml files in a directory (recursively).
+        The files are parsed in parallel in several processes. If there is a cache_dir, the parsed
+        contents are kept there (keyed by file mtime and size), so only the changed files are parsed again
+    """
+    files = find_yaml_files(directory)
+    cache_path = parse_cache_path(cache_dir, directory) if cache_dir else None
+    cached = load_parse_cache(cache_path)
+
+    parsed = {}
+    stale = []
+    for filename in files:
+        stamp = file_stamp(filename)
+        entry = cached.get(filename)
+        if entry is not None and entry[0] == stamp:
+            parsed[filename] = entry
+        else:
+            stale.append((filename, stamp))
+
+    if len(stale) >= MIN_FILES_FOR_PROCESSES and workers != 1:
+        # the time of the other processes isn't recorded there, so we count the whole parse here
+        with recorder.timed('load (processes)'), ProcessPoolExecutor(max_workers=workers) as executor:
+            contents = list(executor.map(read_yaml_queries, [filename for filename, stamp in stale], chunksize=8))
+    else:
+        contents = [read_yaml_queries(filename) for filename, stamp in stale]
+    for (filename, stamp), queries in zip(stale, contents):
+        parsed[filename] = (stamp, queries)
+
+    if cache_path is not None and (stale or len(parsed) != len(cached)):
+        save_parse_cache(cache_path, parsed)
+
+    queries = []
+    for filename in files:
+        queries.extend(parsed[filename][1])
+    return queries
+
+def read_queries(path, cache_dir=None):
+    """
+        Load the queries from a yaml file or from a directory of yaml files
+    """
+    if os.path.isdir(path):
+        return read_yaml_dir(path, cache_dir)
+    return read_yaml(path)
@@ -0,0 +1,206 @@
+"""
+    Instrumentation of a run: what each endpoint of the redash API cost (requests, latency, bytes, retries
+    and errors) and how much time we spent on our side (yaml, filtering...).
+    Recording is off unless the cli is called with --stats or --trace, so it costs nothing otherwise
+"""
+import functools
+import json
+import math
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+import click
+
+# upper bounds (in ms) of the buckets of the latency histogram
+HISTOGRAM_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+# the parts of the paths that are ids, so all the requests to the same kind of object are grouped
+_ID_PATTERN = re.compile(r'/(\d+|[0-9a-fA-F-]{32,36})(?=/|$)')
+_SLUG_PATTERN = re.compile(r'^/api/dashboards/(?!\d+(/|$))[^/]+')
+
+
+def endpoint_name(method, url):
+    """
+        The endpoint of a request, like `GET /api/queries/:id`
+    """
+    path = _SLUG_PATTERN.sub('/api/dashboards/:slug', urlsplit(url).path)
+    path = _ID_PATTERN.sub('/:id', path)
+    return '{} {}'.format(method, path)
+
+
+def percentile(values, fraction):
+    """
+        Nearest rank percentile of the (sorted) values
+    """
+    if not values:
+        return 0.0
+    return values[max(1, math.ceil(fraction * len(values))) - 1]
+
+
+class EndpointStats:
+    """
+        What we know of the requests to one endpoint
+    """
+    def __init__(self):
+        self.durations = []
+        self.waits = []  # until the headers arrived, so the rest of the duration is downloading the body
+        self.sent = 0
+        self.received = 0
+        self.retries = 0
+        self.errors = 0
+        self.statuses = defaultdict(int)
+
+
+class Stats:
+    """
+        Thread safe recorder of requests and timings
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.enabled = False
+        self.trace = False
+        self.reset()
+
+    def reset(self):
+        self.started = time.perf_counter()
+        self.endpoints = defaultdict(EndpointStats)
+        self.timings = defaultdict(lambda: [0, 0.0])  # name -> [calls, seconds]
+
+    def start(self, trace=False):
+        self.reset()
+        self.enabled = True
+        self.trace = trace
+
+    def request(self, method, url, seconds, response=None, error=None, retry=False):
+        """
+            Record one attempt of a request. response is None if the connection failed (error has why)
+        """
+        if not self.enabled:
+            return
+        endpoint = endpoint_name(method, url)
+        status = response.status_code if response is not None else type(error).__name__
+        with self.lock:
+            stats = self.endpoints[endpoint]
+            stats.durations.append(seconds)
+            stats.statuses[status] += 1
+            if retry:
+                stats.retries += 1
+            if response is None or response.status_code >= 400:
+                stats.errors += 1
+            if response is not None:
+                stats.waits.append(response.elapsed.total_seconds())
+                stats.sent += len(response.request.body or b'')
+                stats.received += len(response.content)
+        if self.trace:
+            click.echo('{} {} -> {} {:.0f}ms{}'.format(method, url, status, seconds * 1000, ' (retrying)' if retry else ''), err=True)
+
+    def timed_calls(self, name):
+        """
+            Decorator adding the time of each call of the function to the timing `name`. Unlike `timed`,
+            when we are not recording it costs only a check, so it can wrap functions called for every item
+        """
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return function(*args, **kwargs)
+                with self.timed(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    @contextmanager
+    def timed(self, name):
+        """
+            Add the time spent in the block to the timing `name`
+        """
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self.lock:
+                timing = self.timings[name]
+                timing[0] += 1
+                timing[1] += elapsed
+
+    def report(self):
+        """
+            All we recorded, as a dict that can be dumped as json
+        """
+        with self.lock:
+            endpoints = {}
+            for name, stats in sorted(self.endpoints.items()):
+                durations = sorted(stats.durations)
+                waits = sorted(stats.waits)
+                histogram = [0] * (len(HISTOGRAM_BUCKETS_MS) + 1)
+                for seconds in durations:
+                    bucket = 0
+                    while bucket < len(HISTOGRAM_BUCKETS_MS) and seconds * 1000 > HISTOGRAM_BUCKETS_MS[bucket]:
+                        bucket += 1
+                    histogram[bucket] += 1
+                endpoints[name] = {
+                    'requests': len(durations),
+                    'errors': stats.errors,
+                    'retries': stats.retries,
+                    'statuses': {str(status): count for status, count in stats.statuses.items()},
+                    'total_seconds': sum(durations),
+                    'p50_ms': percentile(durations, 0.50) * 1000,
+                    'p95_ms': percentile(durations, 0.95) * 1000,
+                    'p99_ms': percentile(durations, 0.99) * 1000,
+                    'max_ms': (durations[-1] if durations else 0.0) * 1000,
+                    'wait_p50_ms': percentile(waits, 0.50) * 1000,
+                    'bytes_sent': stats.sent,
+                    'bytes_received': stats.received,
+                    'histogram_ms': dict(zip([str(bound) for bound in HISTOGRAM_BUCKETS_MS] + ['inf'], histogram)),
+                }
+            timings = {name: {'calls': calls, 'seconds': seconds} for name, (calls, seconds) in sorted(self.timings.items())}
+        return {'wall_seconds': time.perf_counter() - self.started, 'endpoints': endpoints, 'timings': timings}
+
+
+def format_json(report):
+    return json.dumps(report, indent=2, sort_keys=True) + '\n'
+
+
+def format_table(report):
+    rows = [('endpoint', 'reqs', 'errs', 'retry', 'p50ms', 'p95ms', 'p99ms', 'maxms', 'wait50', 'sentKB', 'recvKB')]
+    totals = [0, 0, 0, 0.0, 0, 0]
+    for name, endpoint in report['endpoints'].items():
+        rows.append((name, endpoint['requests'], endpoint['errors'], endpoint['retries'],
+                     '{:.0f}'.format(endpoint['p50_ms']), '{:.0f}'.format(endpoint['p95_ms']),
+                     '{:.0f}'.format(endpoint['p99_ms']), '{:.0f}'.format(endpoint['max_ms']),
+                     '{:.0f}'.format(endpoint['wait_p50_ms']),
+                     '{:.1f}'.format(endpoint['bytes_sent'] / 1024), '{:.1f}'.format(endpoint['bytes_received'] / 1024)))
+        totals[0] += endpoint['requests']
+        totals[1] += endpoint['errors']
+        totals[2] += endpoint['retries']
+        totals[3] += endpoint['total_seconds']
+        totals[4] += endpoint['bytes_sent']
+        totals[5] += endpoint['bytes_received']
+    widths = [max(len(str(row[column])) for row in rows) for column in range(len(rows[0]))]
+    lines = []
+    for row in rows:
+        cells = [str(row[0]).ljust(widths[0])] + [str(cell).rjust(width) for cell, width in zip(row[1:], widths[1:])]
+        lines.append('  '.join(cells))
+    lines.append('')
+    lines.append('{} requests, {} errors, {} retries, {:.2f}s waiting for the server (summed over threads), '
+                 '{:.1f}KB sent, {:.1f}KB received'.format(totals[0], totals[1], totals[2], totals[3], totals[4] / 1024, totals[5] / 1024))
+    for name, timing in report['timings'].items():
+        lines.append('{}: {:.2f}s ({} calls)'.format(name, timing['seconds'], timing['calls']))
+    lines.append('wall time: {:.2f}s'.format(report['wall_seconds']))
+    return '\n'.join(lines) + '\n'
+
+
+FORMATTERS = {
+    'table': format_table,
+    'json': format_json,
+}
+
+# the recorder of this run
+recorder = Stats()
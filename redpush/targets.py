@@ -0,0 +1,160 @@
+"""
+    Pushing the same queries to several redash servers at the same time
+"""
+import copy
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import click
+from redpush import redash
+from redpush.cache import StateCache
+from redpush.repository import read_yaml
+
+
+def read_targets(filename):
+    """
+        Read the servers to push to from a yaml (or json) file, a list of:
+            - name: prod
+              redash_url: https://redash.example.com
+              api_key_env: PROD_REDASH_KEY   # or api_key, but better not to have keys in files
+        Raises an error explaining what is wrong if any target is not valid
+    """
+    targets = read_yaml(filename)
+    if not isinstance(targets, list) or not targets:
+        raise click.ClickException('The targets file {} must have a list of targets'.format(filename))
+    errors = []
+    names = set()
+    for position, target in enumerate(targets):
+        if not isinstance(target, dict):
+            errors.append('target {} is not a dict'.format(position))
+            continue
+        name = target.setdefault('name', target.get('redash_url') or 'target {}'.format(position))
+        if name in names:
+            errors.append('{}: repeated name'.format(name))
+        names.add(name)
+        if not target.get('redash_url'):
+            errors.append('{}: no redash_url'.format(name))
+        if 'api_key_env' in target:
+            target['api_key'] = os.environ.get(target['api_key_env'])
+            if not target['api_key']:
+                errors.append('{}: the environment variable {} is not set'.format(name, target['api_key_env']))
+        elif not target.get('api_key'):
+            errors.append('{}: no api_key or api_key_env'.format(name))
+    if errors:
+        raise click.ClickException('Invalid targets in {}:\n  '.format(filename) + '\n  '.join(errors))
+    return targets
+
+
+class TargetOutput:
+    """
+        stdout while pushing to several targets at the same time: each line is prefixed with the name of the
+        target it is about. The thread of each target is registered with its name, and the threads it starts
+        (the pipeline stages keep their parent thread) print with the same name.
+        Lines are written whole, so the lines of different targets are not mixed
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.names = {}  # thread -> target name
+        self.pending = {}  # thread -> what it printed of a line not finished yet
+
+    def register(self, name):
+        with self.lock:
+            self.names[threading.current_thread()] = name
+
+    def unregister(self):
+        thread = threading.current_thread()
+        with self.lock:
+            rest = self.pending.pop(thread, '')
+            if rest:
+                self.stream.write('[{}] {}\n'.format(self.names[thread], rest))
+            self.names.pop(thread, None)
+
+    def target_name(self, thread):
+        while thread is not None:
+            if thread in self.names:
+                return self.names[thread]
+            thread = getattr(thread, 'parent', None)
+        return None
+
+    def write(self, text):
+        thread = threading.current_thread()
+        with self.lock:
+            name = self.target_name(thread)
+            if name is None:
+                return self.stream.write(text)
+            lines = (self.pending.pop(thread, '') + text).split('\n')
+            if lines[-1]:
+                self.pending[thread] = lines[-1]
+            for line in lines[:-1]:
+                self.stream.write('[{}] {}\n'.format(name, line))
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def push_target(target, queries, concurrency, cache_dir, output=None):
+    """
+        Push the queries to one target. Returns the result for the report, it never raises
+    """
+    if output is not None:
+        output.register(target['name'])
+    start = time.perf_counter()
+    result = {'name': target['name'], 'redash_url': target['redash_url'], 'error': None, 'summary': None}
+    try:
+        # what is in the server is always downloaded to compare, the cache is only refreshed
+        cache = StateCache(cache_dir, target['redash_url'], refresh=True) if cache_dir else None
+        server = redash.Redash(target['redash_url'], target['api_key'], concurrency, cache=cache)
+        result['summary'] = server.Put_Queries(server.Iter_Server_State(), queries)
+    except Exception as error:
+        result['error'] = '{}: {}'.format(type(error).__name__, error)
+        print('push failed, {}'.format(result['error']), flush=True)
+    finally:
+        if output is not None:
+            output.unregister()
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def push_targets(targets, queries, concurrency=8, cache_dir=None, parallel=None):
+    """
+        Push the queries (already read and checked) to all the targets at the same time, each one in a thread
+        with its own connections, cache and `concurrency` requests.
+        Put_Queries changes the queries it gets, so each target gets its own copy.
+        What is printed while pushing is prefixed with the name of its target (check TargetOutput).
+        Returns the results of each target, in the same order
+    """
+    parallel = parallel or len(targets)
+    stdout = sys.stdout
+    output = TargetOutput(stdout)
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=parallel) as executor:
+            futures = [executor.submit(push_target, target, copy.deepcopy(queries), concurrency, cache_dir, output) for target in targets]
+            return [future.result() for future in futures]
+    finally:
+        sys.stdout = stdout
+
+
+def format_report(results):
+    rows = [('target', 'result', 'queries', 'visualizations', 'widgets', 'seconds')]
+    for result in results:
+        counts = []
+        for kind in ['queries', 'visualizations', 'widgets']:
+            if result['summary'] is None:
+                counts.append('-')
+            else:
+                kind_counts = result['summary'][kind]
+                counts.append('{}/{}/{}'.format(kind_counts['created'], kind_counts['updated'], kind_counts['unchanged']))
+        rows.append((result['name'], 'failed' if result['error'] else 'ok') + tuple(counts) + ('{:.1f}'.format(result['seconds']),))
+    widths = [max(len(str(row[column])) for row in rows) for column in range(len(rows[0]))]
+    lines = ['  '.join(str(cell).ljust(width) for cell, width in zip(row, widths)).rstrip() for row in rows]
+    lines.append('(created/updated/unchanged)')
+    for result in results:
+        if result['error']:
+            lines.append('{}: {}'.format(result['name'], result['error']))
+    return '\n'.join(lines) + '\n'
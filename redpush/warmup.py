@@ -0,0 +1,107 @@
+"""
+    Running the queries after a push, so the dashboards have results when people open them.
+    Each query is executed through the query_results api and its job is polled until it finishes
+"""
+import threading
+import time
+from collections import Counter
+
+# status of the jobs of redash
+JOB_PENDING, JOB_STARTED, JOB_SUCCESS, JOB_FAILURE, JOB_CANCELLED = 1, 2, 3, 4, 5
+# how often we ask for the status of a job, it grows up to the maximum while the job runs
+POLL_SECONDS = 0.5
+MAX_POLL_SECONDS = 5
+
+
+def has_parameters(query):
+    """
+        Queries with parameters can't be run without values for them, so we leave them alone
+    """
+    return bool((query.get('options') or {}).get('parameters')) or '{{' in (query.get('query') or '')
+
+
+def run_query(server, query, timeout):
+    """
+        Execute a query and wait for its job. Returns the result for the report
+    """
+    result = {'id': query['id'], 'name': query.get('name'), 'data_source_id': query.get('data_source_id'), 'error': None}
+    start = time.perf_counter()
+    response = server.post_json('{}/api/query_results'.format(server.url), {
+        'query_id': query['id'],
+        'data_source_id': query.get('data_source_id'),
+        'query': query.get('query'),
+        'max_age': 0,  # always run it, even if there is a cached result
+        'parameters': {},
+    })
+    if 'query_result' in response:
+        result['status'] = 'ok'
+    elif 'job' not in response:
+        result['status'] = 'failed'
+        result['error'] = response.get('message', str(response))
+    else:
+        job = response['job']
+        poll = POLL_SECONDS
+        while job['status'] in (JOB_PENDING, JOB_STARTED):
+            if time.perf_counter() - start > timeout:
+                break
+            time.sleep(poll)
+            poll = min(poll * 2, MAX_POLL_SECONDS)
+            job = server.get_json('{}/api/jobs/{}'.format(server.url, job['id']))['job']
+        if job['status'] == JOB_SUCCESS:
+            result['status'] = 'ok'
+        elif job['status'] in (JOB_PENDING, JOB_STARTED):
+            result['status'] = 'timeout'
+        else:
+            result['status'] = 'failed'
+            result['error'] = job.get('error') or 'cancelled'
+    result['seconds'] = time.perf_counter() - start
+    return result
+
+
+def warm_up(server, queries, per_data_source=2, timeout=300):
+    """
+        Run the queries (dicts with id, query, data_source_id...) in the server, up to `concurrency` at the same
+        time but no more than per_data_source in each data source, so we don't overload the databases.
+        Returns the result of each query: status (ok, failed, timeout or skipped), seconds and error
+    """
+    locks = {}
+    locks_lock = threading.Lock()
+
+    def data_source_lock(data_source_id):
+        with locks_lock:
+            if data_source_id not in locks:
+                locks[data_source_id] = threading.BoundedSemaphore(max(1, per_data_source))
+            return locks[data_source_id]
+
+    def warm_query(query):
+        if has_parameters(query):
+            return {'id': query['id'], 'name': query.get('name'), 'data_source_id': query.get('data_source_id'),
+                    'status': 'skipped', 'error': 'it has parameters', 'seconds': 0.0}
+        with data_source_lock(query.get('data_source_id')):
+            print('running query {} ({})'.format(query['id'], query.get('name')), flush=True)
+            try:
+                return run_query(server, query, timeout)
+            except Exception as error:
+                return {'id': query['id'], 'name': query.get('name'), 'data_source_id': query.get('data_source_id'),
+                        'status': 'failed', 'error': '{}: {}'.format(type(error).__name__, error), 'seconds': 0.0}
+
+    # the queries of different data sources are interleaved, so one busy data source doesn't hold all the workers
+    by_data_source = {}
+    for query in queries:
+        by_data_source.setdefault(query.get('data_source_id'), []).append(query)
+    interleaved = []
+    while any(by_data_source.values()):
+        for pending in by_data_source.values():
+            if pending:
+                interleaved.append(pending.pop(0))
+    return server.map_concurrent(warm_query, interleaved)
+
+
+def print_warm_up(results):
+    counts = Counter(result['status'] for result in results)
+    for result in sorted(results, key=lambda result: -result['seconds']):
+        line = 'query {} ({}): {} in {:.1f}s'.format(result['id'], result['name'], result['status'], result['seconds'])
+        if result['error']:
+            line += ', ' + str(result['error'])
+        print(line, flush=True)
+    print('warm up: {} ok, {} failed, {} timeout, {} skipped'.format(counts['ok'], counts['failed'], counts['timeout'], counts['skipped']), flush=True)
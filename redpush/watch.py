@@ -0,0 +1,144 @@
+"""
+    Watching the yaml files and pushing what changes in them as soon as they are saved.
+    The server is read once: its state is kept in memory (the index) and updated with what is sent, so each
+    change costs only the requests of the queries that changed
+"""
+import copy
+import os
+import time
+import click
+from redpush.index import RedpushIndex, check_duplicate_ids
+from redpush.layout import DashboardLayout
+from redpush.redash import content_hash
+from redpush.repository import find_yaml_files, read_yaml_queries, file_stamp
+
+
+def query_hash(query):
+    """
+        Hash of everything in a query of the file (visualizations and dashboards included), to know if it changed
+    """
+    return content_hash(query, list(query))
+
+
+class Watcher:
+    """
+        Keeps the server state and the last version of each file, and pushes the queries that change.
+        inotify isn't available everywhere (nor in the standard library), so the files are polled: only their
+        mtime and size are checked on each poll, and only the files that changed are parsed again
+    """
+
+    def __init__(self, server, path):
+        self.server = server
+        self.path = path
+        self.files = {}  # filename -> (stamp, queries)
+        self.pushed = {}  # query redpush_id -> hash of the query when it was pushed
+        self.positions = {}  # the widget positions of the last layout pushed
+        self.index = None
+
+    def filenames(self):
+        if os.path.isdir(self.path):
+            return find_yaml_files(self.path)
+        return [self.path] if os.path.exists(self.path) else []
+
+    def load_server(self):
+        """
+            Read the whole server state, at the start or when we can't trust what we have
+        """
+        print('Reading the queries and dashboards of the server', flush=True)
+        self.index = RedpushIndex(self.server.Iter_Server_State(), self.server.Get_Dashboards())
+        self.pushed = {}
+        self.positions = {}
+
+    def read_changes(self):
+        """
+            Parse again the files that changed since the last call. Returns the names of the files
+            that changed (or were removed)
+        """
+        changed = []
+        filenames = self.filenames()
+        for filename in filenames:
+            try:
+                stamp = file_stamp(filename)
+            except OSError:
+                continue  # removed while we were looking
+            if filename in self.files and self.files[filename][0] == stamp:
+                continue
+            changed.append(filename)
+            try:
+                queries = read_yaml_queries(filename)
+            except Exception as error:
+                # usually the file is being saved, it will be read again with the next change
+                print('Error reading {}, keeping the previous version: {}'.format(filename, error), flush=True)
+                queries = self.files[filename][1] if filename in self.files else []
+            self.files[filename] = (stamp, queries)
+        for filename in set(self.files) - set(filenames):
+            print('{} was removed, its queries are left in the server'.format(filename), flush=True)
+            del self.files[filename]
+            changed.append(filename)
+        return changed
+
+    def queries(self):
+        queries = []
+        for filename in sorted(self.files):
+            queries.extend(self.files[filename][1])
+        return queries
+
+    def push_changes(self):
+        """
+            Push the queries that are different from the last time they were pushed.
+            Returns the summary of Put_Queries, or None if there was nothing to push
+        """
+        queries = self.queries()
+        try:
+            check_duplicate_ids(queries)
+        except click.ClickException as error:
+            print(error.format_message(), flush=True)
+            return None
+        # the layout is of all the queries, so the widgets are placed as a full push would. A change in one
+        # query can move the widgets of others in the same dashboard, those are pushed too
+        layout = DashboardLayout(queries)
+        moved = set(key[1] for key in set(layout.positions) | set(self.positions)
+                    if layout.positions.get(key) != self.positions.get(key))
+        hashes = {query['redpush_id']: query_hash(query) for query in queries if 'redpush_id' in query}
+        to_push = [query for query in queries if 'redpush_id' in query and
+                   (self.pushed.get(query['redpush_id']) != hashes[query['redpush_id']] or query['redpush_id'] in moved)]
+        if not to_push:
+            return None
+        if self.index is None:
+            self.load_server()
+        try:
+            # Put_Queries changes the queries it gets, and we keep them to compare with the next version
+            summary = self.server.Put_Queries(None, copy.deepcopy(to_push), self.index, layout)
+        except Exception as error:
+            # we don't know what got to the server, so it is read again and everything is pushed with the next change
+            print('Push failed, {}: {}'.format(type(error).__name__, error), flush=True)
+            self.index = None
+            self.pushed = {}
+            self.positions = {}
+            return None
+        for query in to_push:
+            self.pushed[query['redpush_id']] = hashes[query['redpush_id']]
+        self.positions = layout.positions
+        return summary
+
+    def run(self, interval=0.5):
+        """
+            Push everything once and then keep pushing the changes, until it is interrupted
+        """
+        self.read_changes()
+        self.load_server()
+        self.push_changes()
+        print('Watching {} for changes (ctrl-c to stop)'.format(self.path), flush=True)
+        try:
+            while True:
+                time.sleep(interval)
+                changed = self.read_changes()
+                if not changed:
+                    continue
+                start = time.perf_counter()
+                print('Changed: {}'.format(', '.join(changed)), flush=True)
+                summary = self.push_changes()
+                if summary is not None:
+                    print('Pushed in {:.2f}s'.format(time.perf_counter() - start), flush=True)
+        except KeyboardInterrupt:
+            print('Stopped watching', flush=True)